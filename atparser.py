@@ -0,0 +1,115 @@
+# Parsing of lines received from the modem.  This has no serial or D-Bus
+# dependencies so it can be exercised on its own.
+
+import csv
+from enum import IntEnum
+import ipaddress
+from typing import NamedTuple
+
+# lines longer than this are truncated
+LINE_MAX = 512
+
+ERRORS = ('ERROR', '+CME ERROR:', '+CMS ERROR:')
+
+class ParseError(ValueError):
+    pass
+
+class LINE(IntEnum):
+    OK              = 0     # command completed
+    ERROR           = 1     # command failed
+    ECHO            = 2     # command echo
+    RESP            = 3     # response or unsolicited result
+    IGNORE          = 4     # data link chatter
+
+def cmd_name(cmd):
+    return cmd.lstrip('AT') if cmd else ''
+
+def parse_line(line, lastcmd):
+    """Classify a line received from the modem.
+
+    Returns a (type, cmd, resp) tuple.  For responses without a prefix,
+    and for OK and errors, cmd is taken from the last command sent.
+    """
+
+    if line == 'OK':
+        return LINE.OK, cmd_name(lastcmd), line
+
+    if line.startswith(ERRORS):
+        return LINE.ERROR, cmd_name(lastcmd), line
+
+    if line.startswith('AT'):
+        return LINE.ECHO, cmd_name(line), line
+
+    if line == 'NO CARRIER' or line.startswith('+PPPD:'):
+        return LINE.IGNORE, None, line
+
+    p = line.split(': ', 1)
+
+    if len(p) == 1:
+        return LINE.RESP, cmd_name(lastcmd), line
+
+    return LINE.RESP, p[0], p[1]
+
+def fields(resp):
+    # comma separated values, commas in quoted strings are kept
+    try:
+        return next(csv.reader([resp]), [])
+    except csv.Error as e:
+        raise ParseError(str(e)) from None
+
+def parse_ip(s):
+    # IPv6 addresses are reported either as 16 dotted decimal bytes or,
+    # after AT+CGPIAF, in colon notation
+    try:
+        if ':' in s:
+            ip = ipaddress.ip_address(s)
+        else:
+            ip = ipaddress.ip_address(bytes(map(int, s.split('.'))))
+    except ValueError:
+        return None
+
+    if not any(ip.packed):
+        return None
+
+    return ip
+
+def parse_pdp_addr(v):
+    # dual-stack addresses are separate fields or a single field with
+    # the IPv4 and IPv6 addresses separated by a space
+    ip4 = None
+    ip6 = None
+
+    for a in ' '.join(v).split():
+        ip = parse_ip(a)
+
+        if ip is None:
+            continue
+
+        if ip.version == 4:
+            ip4 = ip4 or ip
+        else:
+            ip6 = ip6 or ip
+
+    return ip4, ip6
+
+class PDPContext(NamedTuple):
+    cid: int
+    pdp_type: str
+    apn: str
+    pdp_addr: str = ''
+    d_comp: int = 0
+    h_comp: int = 0
+    ipv4_ctrl: int = 0
+    emergency: int = 0
+
+    @classmethod
+    def create(cls, *args):
+        if len(args) < 3:
+            raise ParseError('PDP context with %d fields' % len(args))
+
+        # newer firmware reports more fields, these are not used
+        return cls(int(args[0]), *args[1:4],
+                   *(int(a) if a else 0 for a in args[4:8]))
+
+    def __str__(self):
+        return '{},"{}","{}","{}",{},{},{},{}'.format(*self)
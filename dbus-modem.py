@@ -1,11 +1,19 @@
 #!/usr/bin/python3 -u
 
 from argparse import ArgumentParser
+import array
+import bisect
+import collections
 from enum import IntEnum
 import ipaddress
+import itertools
+import json
+import mmap
 import os
 import queue
+import re
 import signal
+import struct
 import sys
 import time
 import threading
@@ -15,9 +23,13 @@ import serial
 from gi.repository import GLib
 import dbus
 import dbus.mainloop.glib
+import dbus.service
 from vedbus import VeDbusService
 from settingsdevice import SettingsDevice
 
+from atparser import LINE, LINE_MAX, PDPContext, fields, parse_line, \
+    parse_pdp_addr
+
 import logging
 log = logging.getLogger()
 
@@ -32,22 +44,137 @@ modem_settings = {
     'apn':     ['/Settings/Modem/APN', '', 0, 0],
     'user':    ['/Settings/Modem/User', '', 0, 0],
     'passwd':  ['/Settings/Modem/Password', '', 0, 0],
+    'pipeline': ['/Settings/Modem/Pipeline', 0, 0, 1],
+    'autoapn': ['/Settings/Modem/AutoAPN', '', 0, 0],
+    'pdptype': ['/Settings/Modem/PDPType', '', 0, 0],
 }
 
+# number of connection profiles, selected by SIM ICCID
+PROFILES = 4
+
+# settings a profile can override
+PROFILE_KEYS = ['pin', 'apn', 'user', 'passwd']
+
+for i in range(1, PROFILES + 1):
+    modem_settings.update({
+        'profile%d_name' % i:   ['/Settings/Modem/Profile/%d/Name' % i, '', 0, 0],
+        'profile%d_iccid' % i:  ['/Settings/Modem/Profile/%d/ICCID' % i, '', 0, 0],
+        'profile%d_pin' % i:    ['/Settings/Modem/Profile/%d/PIN' % i, '', 0, 0],
+        'profile%d_apn' % i:    ['/Settings/Modem/Profile/%d/APN' % i, '', 0, 0],
+        'profile%d_user' % i:   ['/Settings/Modem/Profile/%d/User' % i, '', 0, 0],
+        'profile%d_passwd' % i: ['/Settings/Modem/Profile/%d/Password' % i, '', 0, 0],
+    })
+
 # connection script used by pppd
 CHAT_SCRIPT = '/run/ppp/chat'
 
-# file containing user/password for PPP authentication
+# pppd options file, included by the peer configuration: user/password
+# for PPP authentication and the IP protocols to negotiate
 AUTH_FILE = '/run/ppp/auth'
 
+# supported PDP types, in order of preference unless configured
+PDP_TYPES = ['IP', 'IPV4V6', 'IPV6']
+
 # time allowed for ppp interface to come up
 PPP_TIMEOUT = 60
 
+# APN database, searched by MCC/MNC when no APN is configured
+APN_DB = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'apn.txt')
+
 # max number of commands to queue
 CMDQ_MAX = 15
 
+# queries that can be combined on a single command line when pipelining
+# is enabled.  None of these are expected to fail.  An error aborts the
+# rest of the line (ITU-T V.250) without telling which command failed,
+# so the line is repeated as single commands, and pipelining is turned
+# off after PIPELINE_ERRORS failed lines in a row.
+PIPELINE_CMDS = {
+    'AT+COPS?',
+    'AT+CNSMOD?',
+    'AT+CSQ',
+    'AT+CGACT?',
+    'AT+CGATT?',
+    'AT+CREG?',
+    'AT+CGPADDR',
+}
+
+# max number of commands combined on one line
+PIPELINE_MAX = 8
+
+PIPELINE_ERRORS = 3
+
+# command queue priorities, lower value is sent first
+PRIO_NORMAL = 0
+PRIO_LOW = 1
+
+# directory holding received SMS messages
+SMS_DIR = '/data/var/lib/dbus-modem/sms'
+
+# number of received SMS messages to keep
+SMS_MAX = 50
+
+# max number of outgoing SMS messages waiting to be sent
+SMS_SENDQ_MAX = 5
+
+# max length of a single text mode SMS
+SMS_LEN = 160
+
+SMS_NUMBER = re.compile(r'^\+?[0-9]{3,20}$')
+
+# unsolicited results still acted on while a message is submitted
+SMS_URCS = ('+CMTI:', '+CREG:', '+CPIN:')
+
+SMS_IFACE = 'com.victronenergy.Modem.Sms'
+
+# number of entries in the event log
+EVLOG_SIZE = 1024
+
+# file the event log is saved to when quitting on an error
+EVLOG_FILE = '/data/var/lib/dbus-modem/events.log'
+
+EVLOG_IFACE = 'com.victronenergy.Modem.EventLog'
+
+# debug logging is limited to this many messages per second on average,
+# with bursts of up to DEBUG_BURST messages
+DEBUG_RATE = 50
+DEBUG_BURST = 500
+
+# connection state timeline, the previous file is kept with a .1 suffix
+TIMELINE_FILE = '/data/var/lib/dbus-modem/timeline'
+
+# size at which the timeline file is rotated
+TIMELINE_MAX = 64 * 1024
+
+# min time between timeline writes, seconds
+TIMELINE_FLUSH = 900
+
+# number of buffered timeline records forcing a write
+TIMELINE_PENDING = 256
+
+# window for the statistics published on D-Bus, seconds
+STATS_WINDOW = 24 * 3600
+
+STATS_IFACE = 'com.victronenergy.Modem.Stats'
+
 WDOG_GPIO = 44
 
+# interval between watchdog edges, seconds
+WDOG_INTERVAL = 5
+
+# feed interval considered late, well within the hardware timeout of
+# at least 60 seconds
+WDOG_DEADLINE = 30
+
+# time without response to a command after which the serial link is
+# considered stuck and the watchdog is deliberately no longer fed
+WDOG_STALL = 40
+
+# submitting a message waits for the network and may take longer, the
+# watchdog is fed right before AT+CMGS so this still fits the hardware
+# timeout
+WDOG_STALL_CMGS = 55
+
 # models with save flag in gpio commands
 GPIO_SAVE = [
     'SIMCOM_SIM5360E',
@@ -146,43 +273,56 @@ class PPP_STATUS(IntEnum):
     INIT            = 1
     UP              = 2
 
+class EVENT(IntEnum):
+    CMD             = 1     # command sent
+    RESP            = 2     # response line or unsolicited result
+    OK              = 3     # command completed
+    ERROR           = 4     # command failed
+    STATE           = 5     # state change
+
 def check_route(ifname='ppp0', ipv6=False):
     if ipv6:
         proc = '/proc/net/ipv6_route'
         name = 9
         dest = 0
+        mask = 1
     else:
         proc = '/proc/net/route'
         name = 0
         dest = 1
+        mask = 7
 
     try:
         with open(proc) as f:
             for line in f:
                 r = line.split()
-                if r[name] == ifname and int(r[dest], 16) == 0:
+                if r[name] == ifname and int(r[dest], 16) == 0 and \
+                   int(r[mask], 16) == 0:
                     return True
     except:
         log.warning(traceback.format_exc())
 
     return False
 
-def parse_ip(s):
+def ppp_ipv6_addr(ifname='ppp0'):
+    # global address configured on the interface, the modem only
+    # reports the interface identifier
     try:
-        x = bytes(map(int, s.split('.')))
-    except:
-        return None
-
-    if not any(x):
-        return None
+        with open('/proc/net/if_inet6') as f:
+            for line in f:
+                r = line.split()
+                if r[5] == ifname and int(r[3], 16) == 0:
+                    return ipaddress.ip_address(bytes.fromhex(r[0]))
+    except (OSError, IndexError, ValueError) as e:
+        log.warning('Error reading IPv6 address: %s', e)
 
-    return ipaddress.ip_address(x)
+    return None
 
 def ppp_service(up):
     flag = '-u' if up else '-d'
     os.system('svc %s /service/ppp /service/ppp/log' % flag)
 
-def make_authfile(name, user, passwd):
+def make_options(name, user, passwd, pdp_type='IP'):
     try:
         if not os.access(os.path.dirname(name), os.F_OK):
             os.mkdir(os.path.dirname(name))
@@ -191,9 +331,13 @@ def make_authfile(name, user, passwd):
         if user and passwd:
             f.write('user %s\n' % user)
             f.write('password %s\n' % passwd)
+        if pdp_type != 'IP':
+            f.write('+ipv6\n')
+        if pdp_type == 'IPV6':
+            f.write('noip\n')
         f.close()
     except Exception as e:
-        log.error('Error writing auth file %s: %s', name, e)
+        log.error('Error writing pppd options %s: %s', name, e)
 
 def make_chatscript(name, pdp):
     try:
@@ -210,22 +354,472 @@ def make_chatscript(name, pdp):
     except Exception as e:
         log.error('Error writing chat script %s: %s', name, e)
 
-class PDPContext(NamedTuple):
-    cid: int
-    pdp_type: str
+def mask_pin(s):
+    # keep the PIN out of logs
+    i = s.find('+CPIN=')
+    if i < 0:
+        return s
+    return s[:i + 6] + '****'
+
+class RateLimit(logging.Filter):
+    # token bucket for debug messages, a babbling serial link must not
+    # flood the log
+    def __init__(self, rate, burst):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.dropped = 0
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+
+        now = time.monotonic()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if self.tokens < 1:
+            self.dropped += 1
+            return False
+
+        self.tokens -= 1
+
+        if self.dropped:
+            record.msg = '[%d debug messages dropped] %s' % \
+                (self.dropped, record.getMessage())
+            record.args = None
+            self.dropped = 0
+
+        return True
+
+class ApnEntry(NamedTuple):
     apn: str
-    pdp_addr: str = ''
-    d_comp: int = 0
-    h_comp: int = 0
-    ipv4_ctrl: int = 0
-    emergency: int = 0
+    user: str = ''
+    passwd: str = ''
+
+class ApnDb(object):
+    # Sorted text file with one "MCCMNC<tab>APN<tab>user<tab>password"
+    # line per entry.  The file is mapped and binary searched for each
+    # lookup, nothing is kept in memory.
+
+    def __init__(self, name):
+        self.name = name
+
+    @staticmethod
+    def search(m, key):
+        lo = 0
+        hi = len(m)
+
+        # find the start of the first line with a key not below the one
+        # searched for, comment lines sort before any MCC
+        while lo < hi:
+            mid = (lo + hi) // 2
+            s = m.rfind(b'\n', 0, mid) + 1
+            e = m.find(b'\n', s)
+            if e < 0:
+                e = len(m)
+
+            if m[s:e].split(b'\t', 1)[0] < key:
+                lo = e + 1
+            else:
+                hi = s
 
-    @classmethod
-    def create(cls, *args):
-        return cls(int(args[0]), *args[1:4], *map(int, args[4:]))
+        entries = []
+
+        while lo < len(m):
+            e = m.find(b'\n', lo)
+            if e < 0:
+                e = len(m)
 
-    def __str__(self):
-        return '{},"{}","{}","{}",{},{},{},{}'.format(*self)
+            v = m[lo:e].decode(errors='replace').split('\t')
+            if v[0].encode() != key:
+                break
+
+            # an entry without an APN is of no use
+            if len(v) > 1 and v[1]:
+                entries.append(ApnEntry(*v[1:4]))
+
+            lo = e + 1
+
+        return entries
+
+    def lookup(self, imsi):
+        try:
+            with open(self.name, 'rb') as f, \
+                 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                # MNC is either 2 or 3 digits
+                for n in [6, 5]:
+                    entries = self.search(m, imsi[:n].encode())
+                    if entries:
+                        return imsi[:n], entries
+        except (OSError, ValueError) as e:
+            log.error('Error reading APN database %s: %s', self.name, e)
+
+        return imsi[:5], []
+
+class TIMELINE(IntEnum):
+    START           = 0     # dbus-modem started
+    SIM             = 1     # SIM status
+    REG             = 2     # registration status
+    PPP             = 3     # PPP status
+
+class Timeline(object):
+    # Append-only record of state changes.  Records are buffered and
+    # written in batches to limit flash wear.  Running totals are kept
+    # for each record so statistics for any window need only two lookups.
+
+    REC = struct.Struct('<IBh')
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.pending = bytearray()
+        self.flush_time = time.monotonic()
+        self.nfile = 0
+        self.last = {}
+        self.init_time = None
+
+        self.times = array.array('I')
+        self.ppp = array.array('B')
+        self.uptime = array.array('d')
+        self.conns = array.array('I')
+        self.ttc_sum = array.array('d')
+        self.ttc_num = array.array('I')
+
+    def load(self):
+        for name in [self.name + '.1', self.name]:
+            try:
+                with open(name, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                continue
+            except OSError as e:
+                log.error('Error reading timeline %s: %s', name, e)
+                continue
+
+            data = data[:len(data) - len(data) % self.REC.size]
+            for rec in self.REC.iter_unpack(data):
+                self.derive(*rec)
+
+            if name == self.name:
+                self.nfile = len(data) // self.REC.size
+
+        log.info('Loaded %d timeline records', len(self.times))
+
+        self.add(TIMELINE.START, 0)
+
+    def derive(self, t, kind, value):
+        if self.times:
+            # the clock may be stepped back, keep times ordered
+            t = max(t, self.times[-1])
+            ppp = self.ppp[-1]
+            uptime = self.uptime[-1]
+            # nothing is known about the time before a start, the link
+            # went down when the previous run ended
+            if ppp == PPP_STATUS.UP and kind != TIMELINE.START:
+                uptime += t - self.times[-1]
+            conns = self.conns[-1]
+            ttc_sum = self.ttc_sum[-1]
+            ttc_num = self.ttc_num[-1]
+        else:
+            ppp = PPP_STATUS.DOWN
+            uptime = 0.0
+            conns = 0
+            ttc_sum = 0.0
+            ttc_num = 0
+
+        if kind == TIMELINE.START:
+            ppp = PPP_STATUS.DOWN
+            self.init_time = None
+
+        elif kind == TIMELINE.PPP:
+            if value == PPP_STATUS.INIT and ppp != PPP_STATUS.INIT:
+                self.init_time = t
+            elif value == PPP_STATUS.UP and ppp != PPP_STATUS.UP:
+                conns += 1
+                if self.init_time is not None:
+                    ttc_sum += t - self.init_time
+                    ttc_num += 1
+                    self.init_time = None
+            ppp = value
+
+        self.times.append(t)
+        self.ppp.append(ppp)
+        self.uptime.append(uptime)
+        self.conns.append(conns)
+        self.ttc_sum.append(ttc_sum)
+        self.ttc_num.append(ttc_num)
+
+    def add(self, kind, value):
+        with self.lock:
+            if self.last.get(kind) == value:
+                return
+
+            t = int(time.time())
+
+            # pack first, a value that does not fit must leave the
+            # derived totals and the file in agreement
+            try:
+                rec = self.REC.pack(t, kind, value)
+            except struct.error:
+                log.warning('Timeline value out of range: %s %s',
+                            kind, value)
+                return
+
+            self.last[kind] = value
+            self.derive(t, kind, value)
+            self.pending += rec
+
+    def flush(self, force=False):
+        with self.lock:
+            if not self.pending:
+                return
+
+            if not force and len(self.pending) < \
+               TIMELINE_PENDING * self.REC.size and \
+               time.monotonic() - self.flush_time < TIMELINE_FLUSH:
+                return
+
+            data = self.pending
+            self.pending = bytearray()
+            self.flush_time = time.monotonic()
+
+            try:
+                os.makedirs(os.path.dirname(self.name), exist_ok=True)
+
+                if self.nfile * self.REC.size + len(data) > TIMELINE_MAX:
+                    os.replace(self.name, self.name + '.1')
+                    self.drop(len(self.times) - self.nfile -
+                              len(data) // self.REC.size)
+                    self.nfile = 0
+
+                with open(self.name, 'ab') as f:
+                    f.write(data)
+
+                self.nfile += len(data) // self.REC.size
+            except OSError as e:
+                log.error('Error writing timeline %s: %s', self.name, e)
+
+    def drop(self, n):
+        for a in [self.times, self.ppp, self.uptime, self.conns,
+                  self.ttc_sum, self.ttc_num]:
+            del a[:n]
+
+    def at(self, t):
+        i = bisect.bisect_right(self.times, t) - 1
+        if i < 0:
+            return 0.0, 0, 0.0, 0
+
+        uptime = self.uptime[i]
+        if self.ppp[i] == PPP_STATUS.UP:
+            uptime += t - self.times[i]
+            # up to the next record at most, which is less when that
+            # record is a start
+            if i + 1 < len(self.times):
+                uptime = min(uptime, self.uptime[i + 1])
+
+        return uptime, max(self.conns[i] - 1, 0), \
+            self.ttc_sum[i], self.ttc_num[i]
+
+    def stats(self, start, end):
+        with self.lock:
+            if not self.times:
+                return {}
+
+            start = max(start, self.times[0])
+            end = min(end, time.time())
+
+            if end <= start:
+                return {}
+
+            a = self.at(start)
+            b = self.at(end)
+
+        st = {
+            'Availability': (b[0] - a[0]) / (end - start) * 100,
+            'Reconnects': b[1] - a[1],
+        }
+
+        if b[3] > a[3]:
+            st['MeanTimeToConnect'] = (b[2] - a[2]) / (b[3] - a[3])
+
+        return st
+
+class StatsExport(dbus.service.Object):
+    def __init__(self, bus, path, timeline):
+        super().__init__(bus, path)
+        self.timeline = timeline
+
+    @dbus.service.method(STATS_IFACE, in_signature='dd', out_signature='a{sv}')
+    def Query(self, start, end):
+        return self.timeline.stats(float(start), float(end))
+
+class EventLog(object):
+    # Fixed size ring of binary records.  Adding an entry only packs it
+    # into a preallocated buffer, formatting is done when the log is read.
+
+    REC = struct.Struct('<IdB3xf44s')
+
+    def __init__(self, size):
+        self.size = size
+        self.buf = bytearray(self.REC.size * size)
+        self.seq = itertools.count(1)
+
+    def add(self, kind, data, latency=0.0):
+        n = next(self.seq) & 0xffffffff
+        self.REC.pack_into(self.buf, (n % self.size) * self.REC.size,
+                           n, time.time(), kind, latency,
+                           data.encode(errors='replace'))
+
+    def entries(self):
+        recs = [r for r in self.REC.iter_unpack(bytes(self.buf)) if r[0]]
+        recs.sort()
+        return recs
+
+    def format(self):
+        lines = []
+
+        for seq, t, kind, latency, data in self.entries():
+            s = '%s %-5s %s' % (
+                datetime.fromtimestamp(t).isoformat(sep=' ',
+                                                    timespec='milliseconds'),
+                EVENT(kind).name, data.rstrip(b'\0').decode(errors='replace'))
+            if kind == EVENT.OK or kind == EVENT.ERROR:
+                s += ' (%.0f ms)' % (latency * 1000)
+            lines.append(s)
+
+        return lines
+
+    def save(self, name):
+        try:
+            os.makedirs(os.path.dirname(name), exist_ok=True)
+            with open(name + '.tmp', mode='w') as f:
+                for line in self.format():
+                    f.write(line + '\n')
+            os.replace(name + '.tmp', name)
+        except OSError as e:
+            log.error('Error writing event log %s: %s', name, e)
+            return False
+
+        log.info('Event log saved to %s', name)
+        return True
+
+class EventLogExport(dbus.service.Object):
+    def __init__(self, bus, path, evlog):
+        super().__init__(bus, path)
+        self.evlog = evlog
+
+    @dbus.service.method(EVLOG_IFACE, in_signature='', out_signature='as')
+    def Dump(self):
+        return self.evlog.format()
+
+    @dbus.service.method(EVLOG_IFACE, in_signature='s', out_signature='b')
+    def Save(self, name):
+        # the daemon runs as root, only write next to the default file
+        name = str(name) or os.path.basename(EVLOG_FILE)
+        if os.path.basename(name) != name or name.startswith('.'):
+            log.error('Invalid event log file name: %s', name)
+            return False
+
+        return self.evlog.save(os.path.join(os.path.dirname(EVLOG_FILE), name))
+
+class SmsStore(object):
+    # Received messages are kept in a fixed number of slot files, a new
+    # message overwriting the oldest one.
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.msgs = {}
+        self.seq = 0
+        self.lock = threading.Lock()
+
+    def slot(self, id):
+        return os.path.join(self.path, 'sms-%02d.json' % (id % self.size))
+
+    def load(self):
+        try:
+            names = os.listdir(self.path)
+        except OSError:
+            return
+
+        for n in names:
+            if not n.startswith('sms-') or not n.endswith('.json'):
+                continue
+
+            try:
+                with open(os.path.join(self.path, n)) as f:
+                    msg = json.load(f)
+                self.msgs[int(msg['id'])] = msg
+            except (OSError, ValueError, KeyError) as e:
+                log.warning('Error reading SMS file %s: %s', n, e)
+
+        if self.msgs:
+            self.seq = max(self.msgs)
+
+        log.info('Loaded %d SMS messages', len(self.msgs))
+
+    def write(self, msg):
+        name = self.slot(msg['id'])
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(name + '.tmp', mode='w') as f:
+                json.dump(msg, f)
+            os.replace(name + '.tmp', name)
+        except OSError as e:
+            log.error('Error writing SMS file %s: %s', name, e)
+
+    def add(self, msg):
+        with self.lock:
+            self.seq += 1
+            msg['id'] = self.seq
+            msg['received'] = int(time.time())
+            self.msgs.pop(self.seq - self.size, None)
+            self.msgs[self.seq] = msg
+            self.write(msg)
+
+        return msg
+
+    def delete(self, id):
+        with self.lock:
+            if self.msgs.pop(id, None) is None:
+                return False
+
+            try:
+                os.unlink(self.slot(id))
+            except OSError as e:
+                log.error('Error deleting SMS %d: %s', id, e)
+
+        return True
+
+    def list(self):
+        with self.lock:
+            return [self.msgs[i] for i in sorted(self.msgs)]
+
+class SmsExport(dbus.service.Object):
+    def __init__(self, bus, path, modem):
+        super().__init__(bus, path)
+        self.modem = modem
+
+    @dbus.service.method(SMS_IFACE, in_signature='ss', out_signature='b')
+    def Send(self, number, text):
+        return self.modem.sms_send(str(number), str(text))
+
+    @dbus.service.method(SMS_IFACE, in_signature='', out_signature='aa{sv}')
+    def List(self):
+        return self.modem.sms.list()
+
+    @dbus.service.method(SMS_IFACE, in_signature='u', out_signature='b')
+    def Delete(self, id):
+        return self.modem.sms.delete(int(id))
+
+    @dbus.service.signal(SMS_IFACE, signature='a{sv}')
+    def Received(self, msg):
+        pass
 
 class Modem(object):
     def __init__(self, dev, rate, debug=0):
@@ -235,8 +829,17 @@ class Modem(object):
         self.dev = dev
         self.rate = rate
         self.line = None
-        self.cmds = queue.Queue()
+        self.rawline = None
+        self.cmds = queue.PriorityQueue()
+        self.cmdseq = itertools.count()
         self.lastcmd = None
+        self.cmd_log = None
+        self.pipeline = True
+        self.pipeline_errors = 0
+        self.pipeline_retry = set()
+        self.cmd_time = None
+        self.evlog = EventLog(EVLOG_SIZE)
+        self.timeline = Timeline(TIMELINE_FILE)
         self.ready = False
         self.running = None
         self.registered = None
@@ -244,16 +847,51 @@ class Modem(object):
         self.ppp = None
         self.ppp_time = None
         self.sim_status = None
+        self.iccid = None
+        self.profile = None
+        self.imsi = None
+        self.apndb = ApnDb(APN_DB)
+        self.apn_plmn = None
+        self.apn_cands = None
+        self.apn_idx = 0
+        self.apn_ok = False
         self.wdog = 0
+        self.wdog_due = False
+        self.wdog_sent = None
+        self.wdog_last = None
+        self.wdog_feeds = 0
+        self.wdog_min = None
+        self.wdog_max = None
+        self.wdog_jitter = 0.0
+        self.wdog_late = 0
+        self.wdog_skipped = 0
+        self.wdog_stalled = False
+        self.wdog_held = None
         self.gpio_save = ''
         self.pdp = []
         self.pdp_cid = None
+        self.pdp_type = None
         self.pdp_act = []
+        self.pdp_ip6 = None
+        self.sms = SmsStore(SMS_DIR, SMS_MAX)
+        self.sms_export = None
+        self.sms_mem = None
+        self.sms_rx = None
+        self.sms_out = collections.deque()
+        self.sms_text = None
+        self.sms_prompt = False
+        self.sms_sent = False
+        self.sms_result = False
 
     def error(self, msg):
         global mainloop
 
-        log.error('%s, quitting' % msg)
+        log.error('%s, quitting', msg)
+
+        self.evlog.add(EVENT.STATE, msg)
+        self.evlog.save(EVLOG_FILE)
+        self.timeline.add(TIMELINE.PPP, PPP_STATUS.DOWN)
+        self.timeline.flush(True)
 
         try:
             mainloop.quit()
@@ -273,37 +911,86 @@ class Modem(object):
             if c == b'\n':
                 break
             elif c:
-                self.line += c
+                if len(self.line) < LINE_MAX:
+                    self.line += c
+                if self.sms_prompt and self.line.endswith(b'> '):
+                    self.line = None
+                    self.rawline = '>'
+                    return '>'
             else:
                 return None
 
-        r = self.line.strip().decode()
+        self.rawline = self.line.rstrip(b'\r').decode(errors='replace')
         self.line = None
 
-        return r
+        return self.rawline.strip()
 
     def send(self, cmd):
         self.lastcmd = cmd
+        self.cmd_time = time.monotonic()
         self.ready = False
+        self.sms_prompt = cmd.startswith('AT+CMGS=')
+        self.sms_sent = False
 
-        log.debug('> %s' % cmd)
+        if self.sms_prompt:
+            self.sms_text = self.sms_out.popleft()
+
+        self.cmd_log = mask_pin(cmd)
+        log.debug('> %s', self.cmd_log)
+        self.evlog.add(EVENT.CMD, self.cmd_log)
         try:
             self.ser.write(b'\r' + cmd.encode() + b'\r')
         except serial.SerialException:
             self.error('Write error')
 
-    def cmd(self, cmds, limit=False):
-        if limit and self.cmds.qsize() > CMDQ_MAX:
+    def pending(self, prio):
+        return sum(1 for c in list(self.cmds.queue) if c[0] <= prio)
+
+    def cmd(self, cmds, limit=False, prio=PRIO_NORMAL):
+        if limit and self.pending(prio) > CMDQ_MAX:
             return
 
         try:
             for c in cmds:
-                self.cmds.put(c)
+                self.cmds.put((prio, next(self.cmdseq), c))
         except queue.ShutDown:
             pass
 
         self.ser.cancel_read()
 
+    def next_cmd(self):
+        cmd = self.cmds.get(False)[-1]
+
+        if cmd in self.pipeline_retry:
+            self.pipeline_retry.discard(cmd)
+            return cmd
+
+        if not (self.pipeline and self.settings['pipeline']) or \
+           cmd not in PIPELINE_CMDS:
+            return cmd
+
+        cmds = [cmd]
+
+        while len(cmds) < PIPELINE_MAX:
+            try:
+                c = self.cmds.get(False)
+            except queue.Empty:
+                break
+
+            self.cmds.task_done()
+
+            if c[-1] not in PIPELINE_CMDS or c[-1] in cmds or \
+               c[-1] in self.pipeline_retry:
+                # not combinable, put back keeping its place in the queue
+                self.cmds.put(c)
+                break
+
+            cmds.append(c[-1])
+
+        # responses are matched to the commands by their prefix, the
+        # echo and final OK are passed on for each command
+        return 'AT' + ';'.join(c[2:] for c in cmds)
+
     def modem_wait(self):
         try:
             self.ser.timeout = 10
@@ -312,7 +999,7 @@ class Modem(object):
                 if not self.ready:
                     self.send('AT')
 
-                line = self.ser.readline().decode()
+                line = self.ser.readline().decode(errors='replace')
 
                 # startup chatter complete
                 if not line and self.ready:
@@ -325,7 +1012,7 @@ class Modem(object):
 
                 line = line.strip()
 
-                log.debug('< %s' % line)
+                log.debug('< %s', line)
 
                 # command succeeded
                 if line == 'OK':
@@ -346,6 +1033,7 @@ class Modem(object):
             'AT+CGMM',
             'AT+CGSN',
             'AT+CMEE=1',
+            'AT+CICCID',
             'AT+CPIN?',
         ])
 
@@ -374,10 +1062,162 @@ class Modem(object):
             'AT+CGSETV=%d,1' % WDOG_GPIO,
         ])
 
-    def wdog_update(self):
-        self.cmd(['AT+CGSETV=%d,%d%s' % (WDOG_GPIO, self.wdog, self.gpio_save)],
-                 limit=True)
+    def wdog_cmd(self):
+        cmd = 'AT+CGSETV=%d,%d%s' % (WDOG_GPIO, self.wdog, self.gpio_save)
         self.wdog ^= 1
+        self.wdog_sent = cmd
+        return cmd
+
+    def wdog_update(self):
+        if not self.running:
+            return True
+
+        if self.lastcmd and self.lastcmd.startswith('AT+CMGS='):
+            stall = WDOG_STALL_CMGS
+        else:
+            stall = WDOG_STALL
+
+        if not self.ready and time.monotonic() - self.cmd_time > stall:
+            if not self.wdog_stalled:
+                log.error('No response to %s, not feeding watchdog',
+                          self.cmd_log)
+                self.evlog.add(EVENT.STATE, 'watchdog feeding stopped')
+                self.wdog_stalled = True
+            self.wdog_due = False
+            self.wdog_skipped += 1
+            self.dbus['/Watchdog/Skipped'] = self.wdog_skipped
+            return True
+
+        if self.wdog_stalled:
+            log.info('Modem responding again, feeding watchdog')
+            self.evlog.add(EVENT.STATE, 'watchdog feeding resumed')
+            self.wdog_stalled = False
+
+        # the edge is sent from the reserved slot checked by the reader
+        # thread ahead of the command queue
+        self.wdog_due = True
+        self.ser.cancel_read()
+
+        return True
+
+    def wdog_fed(self):
+        now = time.monotonic()
+        last = self.wdog_last
+
+        self.wdog_last = now
+        self.wdog_feeds += 1
+        self.dbus['/Watchdog/Feeds'] = self.wdog_feeds
+
+        if last is None:
+            return
+
+        t = now - last
+
+        if self.wdog_min is None or t < self.wdog_min:
+            self.wdog_min = t
+            self.dbus['/Watchdog/IntervalMin'] = round(t, 3)
+
+        if self.wdog_max is None or t > self.wdog_max:
+            self.wdog_max = t
+            self.dbus['/Watchdog/IntervalMax'] = round(t, 3)
+
+        # smoothed deviation from the nominal interval, as in RFC 3550
+        self.wdog_jitter += (abs(t - WDOG_INTERVAL) - self.wdog_jitter) / 16
+        self.dbus['/Watchdog/Jitter'] = round(self.wdog_jitter, 3)
+
+        if t > WDOG_DEADLINE:
+            log.warning('Watchdog fed %.1f seconds after previous edge', t)
+            self.wdog_late += 1
+            self.dbus['/Watchdog/Late'] = self.wdog_late
+
+    def conf(self, key):
+        if self.profile:
+            val = self.settings['profile%d_%s' % (self.profile, key)]
+            if val:
+                return val
+
+        return self.settings[key]
+
+    def clear_conf(self, key):
+        if self.profile:
+            pkey = 'profile%d_%s' % (self.profile, key)
+            if self.settings[pkey]:
+                self.settings[pkey] = ''
+                return
+
+        self.settings[key] = ''
+
+    def select_profile(self):
+        prof = None
+
+        if self.iccid:
+            for i in range(1, PROFILES + 1):
+                iccid = self.settings['profile%d_iccid' % i]
+                if iccid and self.iccid.startswith(iccid):
+                    prof = i
+                    break
+
+        if prof == self.profile:
+            return False
+
+        self.profile = prof
+        self.apn_cands = None
+
+        if prof:
+            name = self.settings['profile%d_name' % prof] or str(prof)
+            log.info('Using profile %s for SIM %s', name, self.iccid)
+        else:
+            name = None
+            log.info('No profile for SIM %s, using default settings',
+                     self.iccid)
+
+        self.dbus['/Profile'] = name
+
+        return True
+
+    def switch_pdp(self):
+        apn = self.conf('apn')
+        ctx = None
+
+        if apn:
+            for c in self.pdp:
+                if c.apn == apn and not c.emergency:
+                    ctx = c
+                    break
+
+        if ctx is None:
+            self.select_pdp()
+            return
+
+        # context already defined, switch to it without detaching
+        log.info('Switching to PDP context %s', ctx)
+        self.disconnect()
+        self.pdp_cid = ctx.cid
+        self.pdp_type = ctx.pdp_type
+        self.cmd([
+            'AT+CGACT?',
+            'AT+CGATT=1',
+            'AT+CGATT?',
+        ])
+
+    def profile_apns(self):
+        apns = set([self.settings['apn']])
+
+        for i in range(1, PROFILES + 1):
+            apns.add(self.settings['profile%d_apn' % i])
+
+        apns.discard('')
+
+        return apns
+
+    def free_cid(self):
+        cids = set(c.cid for c in self.pdp)
+        cid = 1
+
+        while cid in cids:
+            cid += 1
+
+        return cid
 
     def select_pdp(self):
         self.disconnect()
@@ -403,34 +1243,225 @@ class Modem(object):
             except ValueError:
                 pref = 1000
 
-            cl.append((not act, pref, ctx.apn != apn, i, ctx))
+            # prefer a context already defined with the wanted APN
+            cl.append((bool(apn) and ctx.apn != apn, not act, pref, i, ctx))
 
         return min(cl)[-1] if cl else None
 
     def update_pdp(self):
         defpdp = False
-        apn = self.settings['apn']
-        types = ['IP', 'IPV4V6', 'IPV6']
+        apn = self.conf('apn')
+        pdp_type = self.settings['pdptype'].upper()
+        types = list(PDP_TYPES)
+
+        if pdp_type in types:
+            types.remove(pdp_type)
+            types.insert(0, pdp_type)
+        elif pdp_type:
+            log.error('Unsupported PDP type: %s', pdp_type)
+            pdp_type = None
+
         ctx = self.find_pdp(types, apn)
 
         if not ctx:
             ctx = PDPContext.create(1, types[0], apn)
             defpdp = True
 
+        if pdp_type and pdp_type != ctx.pdp_type:
+            log.info('Overriding PDP type: %s -> %s', ctx.pdp_type, pdp_type)
+            ctx = ctx._replace(pdp_type=pdp_type)
+            defpdp = True
+
         if apn and apn != ctx.apn:
             apn = apn.strip()
             log.info('Overriding APN: "%s" -> "%s"', ctx.apn, apn)
+
+            # keep contexts used by other profiles for fast switching
+            if ctx.apn in self.profile_apns():
+                ctx = ctx._replace(cid=self.free_cid())
+
             ctx = ctx._replace(apn=apn)
             defpdp = True
 
+        if not apn:
+            cand = self.apn_auto(ctx)
+            if cand and cand.apn != ctx.apn:
+                log.info('Trying APN: "%s" -> "%s"', ctx.apn, cand.apn)
+                ctx = ctx._replace(apn=cand.apn)
+                defpdp = True
+
         if defpdp:
             log.info('Defining PDP context: %s', ctx)
             self.cmd(['AT+CGDCONT=%s' % str(ctx)])
+            self.pdp = [c for c in self.pdp if c.cid != ctx.cid] + [ctx]
 
         log.info('Using PDP context %d', ctx.cid)
         self.pdp_cid = ctx.cid
+        self.pdp_type = ctx.pdp_type
         self.cmd(['AT+CGATT=1'])
 
+    def apn_candidates(self, ctx):
+        plmn, entries = self.apndb.lookup(self.imsi)
+        cands = []
+
+        saved = self.settings['autoapn'].split(',', 1)
+        if len(saved) == 2 and saved[0] == plmn:
+            cands += [e for e in entries if e.apn == saved[1]]
+            cands.append(ApnEntry(saved[1]))
+
+        # keep a context the modem already has up
+        if ctx.apn and ctx.cid in self.pdp_act:
+            cands.append(ApnEntry(ctx.apn))
+
+        cands += entries
+
+        if ctx.apn:
+            cands.append(ApnEntry(ctx.apn))
+
+        # let the network choose
+        cands.append(ApnEntry(''))
+
+        apns = set()
+        self.apn_plmn = plmn
+        self.apn_cands = []
+
+        for c in cands:
+            if c.apn not in apns:
+                apns.add(c.apn)
+                self.apn_cands.append(c)
+
+        log.info('APN candidates for %s: %s', plmn,
+                 ', '.join('"%s"' % c.apn for c in self.apn_cands))
+
+    def apn_auto(self, ctx):
+        if not self.imsi:
+            return None
+
+        if self.apn_cands is None:
+            self.apn_candidates(ctx)
+            self.apn_idx = 0
+            self.apn_ok = False
+
+        return self.apn_cands[self.apn_idx]
+
+    def apn_current(self):
+        if self.apn_cands and not self.conf('apn'):
+            return self.apn_cands[self.apn_idx]
+        return None
+
+    def apn_next(self):
+        if self.apn_current() is None or self.apn_ok:
+            return False
+
+        if self.apn_idx + 1 >= len(self.apn_cands):
+            return False
+
+        log.error('No connection with APN "%s", trying next',
+                  self.apn_cands[self.apn_idx].apn)
+
+        self.apn_idx += 1
+        self.select_pdp()
+
+        return True
+
+    def apn_save(self):
+        cand = self.apn_current()
+        if cand is None or self.apn_ok:
+            return
+
+        self.apn_ok = True
+
+        saved = '%s,%s' % (self.apn_plmn, cand.apn)
+        if self.settings['autoapn'] != saved:
+            log.info('Remembering APN "%s" for %s', cand.apn, self.apn_plmn)
+            self.settings['autoapn'] = saved
+
+    def sms_init(self):
+        self.sms_mem = None
+        self.cmd([
+            'AT+CMGF=1',
+            'AT+CSCS="IRA"',
+            'AT+CSDH=1',
+            'AT+CNMI=2,1,0,0,0',
+            'AT+CMGL="REC UNREAD"',
+            'AT+CMGD=0,1',
+        ], prio=PRIO_LOW)
+
+    def sms_fetch(self, mem, index):
+        cmds = []
+
+        if mem != self.sms_mem:
+            cmds.append('AT+CPMS="%s"' % mem)
+            self.sms_mem = mem
+
+        cmds.append('AT+CMGR=%d' % index)
+        cmds.append('AT+CMGD=%d' % index)
+
+        self.cmd(cmds, prio=PRIO_LOW)
+
+    def sms_header(self, cmd, v):
+        self.sms_finish()
+
+        if cmd == '+CMGL':
+            v.pop(0)
+
+        # with AT+CSDH=1 the header ends with the length of the text,
+        # the lines following it are only a part of the message until
+        # that many characters have been read
+        need = int(v[-1]) if len(v) > 4 else 1
+
+        self.sms_rx = {
+            'sender': v[1],
+            'time': v[3] if len(v) > 3 else '',
+            'text': [],
+            'need': need,
+        }
+
+    def sms_body(self):
+        msg = self.sms_rx
+        text = self.rawline
+
+        msg['text'].append(text)
+        msg['need'] -= len(text) + 1
+
+    def sms_finish(self):
+        msg = self.sms_rx
+        if msg is None:
+            return
+
+        self.sms_rx = None
+        del msg['need']
+        msg['text'] = '\n'.join(msg['text'])
+        msg = self.sms.add(msg)
+
+        log.info('SMS %d received from %s', msg['id'], msg['sender'])
+
+        if self.sms_export:
+            self.sms_export.Received(msg)
+
+    def sms_send(self, number, text):
+        if self.sim_status != SIM_STATUS.READY:
+            log.error('Cannot send SMS, SIM not ready')
+            return False
+
+        if not SMS_NUMBER.match(number):
+            log.error('Cannot send SMS, invalid number: %s', number)
+            return False
+
+        if len(text) > SMS_LEN or not text.isprintable():
+            log.error('Cannot send SMS, invalid message text')
+            return False
+
+        if len(self.sms_out) >= SMS_SENDQ_MAX:
+            log.error('Cannot send SMS, too many messages queued')
+            return False
+
+        log.info('Sending SMS to %s', number)
+        self.sms_out.append(text)
+        self.cmd(['AT+CMGS="%s"' % number], prio=PRIO_LOW)
+
+        return True
+
     def handle_echo(self, cmd):
         if cmd == '+CGACT?':
             self.pdp_act = []
@@ -445,6 +1476,16 @@ class Modem(object):
             self.update_pdp()
             return
 
+        if cmd.startswith('+CMGR') or cmd.startswith('+CMGL'):
+            self.sms_finish()
+            return
+
+        # only edges from the timer are feeds, not the initial setup
+        if self.wdog_sent and 'AT' + cmd == self.wdog_sent:
+            self.wdog_sent = None
+            self.wdog_fed()
+            return
+
     def handle_resp(self, cmd, resp):
         if cmd == '+CGMM':
             self.dbus['/Model'] = resp
@@ -456,18 +1497,39 @@ class Modem(object):
             self.dbus['/IMEI'] = resp
             return
 
+        if cmd == '+ICCID':
+            iccid = resp.rstrip('Ff')
+            if iccid != self.iccid:
+                self.iccid = iccid
+                self.dbus['/ICCID'] = iccid
+                if self.select_profile() and self.registered:
+                    self.switch_pdp()
+            return
+
+        if cmd == '+CIMI':
+            if resp.isdigit() and resp != self.imsi:
+                self.imsi = resp
+                self.apn_cands = None
+            return
+
         if cmd == '+CPIN':
             prev_status = self.sim_status
             self.sim_status = CPIN.get(resp, SIM_STATUS.ERROR)
             self.dbus['/SimStatus'] = self.sim_status
 
+            if self.sim_status != prev_status:
+                self.evlog.add(EVENT.STATE, 'SimStatus %d' % self.sim_status)
+                self.timeline.add(TIMELINE.SIM, self.sim_status)
+
             if self.sim_status == SIM_STATUS.SIM_PIN:
-                if not self.settings['pin']:
-                    log.error('SIM PIN required but not configured: %s' % resp)
+                self.select_profile()
+
+                if not self.conf('pin'):
+                    log.error('SIM PIN required but not configured: %s', resp)
                     return
 
                 log.info('SIM PIN required, sending')
-                pin = self.settings['pin']
+                pin = self.conf('pin')
                 self.cmd(['AT+CPIN=%s' % pin])
 
             elif self.sim_status == SIM_STATUS.READY:
@@ -477,20 +1539,39 @@ class Modem(object):
                     else:
                         log.info('SIM PIN not required')
 
+                    if self.select_profile() and self.registered:
+                        self.switch_pdp()
+
+                    self.cmd(['AT+CICCID', 'AT+CIMI'])
+                    self.sms_init()
+
             else:
-                log.error('Unknown SIM-PIN status: %s' % resp)
+                log.error('Unknown SIM-PIN status: %s', resp)
+
+            return
 
+        if cmd == '+CMGR' or cmd == '+CMGL':
+            self.sms_header(cmd, fields(resp))
             return
 
-        v = list(map(lambda x: x.strip('"'), resp.split(',')))
+        v = fields(resp)
+
+        if cmd == '+CMTI':
+            self.sms_fetch(v[0], int(v[1]))
+            return
+
+        if cmd == '+CMGS':
+            log.info('SMS sent, reference %s', v[0])
+            return
 
         if cmd == '+CNSMOD':
-            self.dbus['/NetworkType'] = NET_MODE[int(v[1])]
+            self.dbus['/NetworkType'] = NET_MODE.get(int(v[1]))
             return
 
         if cmd == '+CREG':
             prev = self.registered
-            stat = REG_STATUS.get(int(v[1]))
+            # unsolicited results only carry the status
+            stat = REG_STATUS.get(int(v[1] if len(v) > 1 else v[0]))
 
             if stat == REG_STATUS.HOME:
                 self.registered = True
@@ -505,6 +1586,10 @@ class Modem(object):
             if self.registered and not prev:
                 self.select_pdp()
 
+            if stat != self.dbus['/RegStatus']:
+                self.evlog.add(EVENT.STATE, 'RegStatus %d' % stat)
+                self.timeline.add(TIMELINE.REG, stat)
+
             self.dbus['/RegStatus'] = stat
             self.dbus['/Roaming'] = self.roaming
             return
@@ -551,12 +1636,13 @@ class Modem(object):
 
         if cmd == '+CGPADDR':
             if int(v[0]) == self.pdp_cid:
-                ip = parse_ip(v[1])
+                ip4, ip6 = parse_pdp_addr(v[1:])
 
-                if ip is not None:
-                    ip = str(ip)
+                if ip4 is not None:
+                    ip4 = str(ip4)
 
-                self.dbus['/IP'] = ip
+                self.dbus['/IP'] = ip4
+                self.pdp_ip6 = ip6
 
             return
 
@@ -565,16 +1651,36 @@ class Modem(object):
                 self.cmd(['AT+CGPS=1'])
             return
 
+    def pipeline_failed(self, cmd, err):
+        log.warning('Combined commands %s failed: %s', cmd, err)
+
+        # a transient error, such as SIM busy, is not a reason to stop
+        self.pipeline_errors += 1
+        if self.pipeline_errors >= PIPELINE_ERRORS:
+            log.warning('No longer combining commands')
+            self.evlog.add(EVENT.STATE, 'pipelining disabled')
+            self.pipeline = False
+
+        # repeat as single commands, those after the failing one were
+        # not run
+        cmds = ['AT' + c for c in cmd.split(';')]
+        self.pipeline_retry.update(cmds)
+        self.cmd(cmds)
+
     def handle_error(self, cmd, err):
+        if ';' in cmd:
+            self.pipeline_failed(cmd, err)
+            return
+
         v = err.split(': ', 1)
         if len(v) > 1:
             err = v[1]
 
-        log.error('%s: command failed: %s' % (cmd, err))
+        log.error('%s: command failed: %s', mask_pin(cmd), err)
 
         try:
             err = int(err)
-        except:
+        except ValueError:
             # some errors are reported as strings, ignore failure
             pass
 
@@ -584,19 +1690,25 @@ class Modem(object):
             # clear stored PIN if incorrect
             if self.sim_status == SIM_STATUS.BAD_PASSWD:
                 log.info('Wrong PIN, clearing stored value')
-                self.settings['pin'] = ''
+                self.clear_conf('pin')
+
+        if cmd.startswith('+CMGR') or cmd.startswith('+CMGL'):
+            self.sms_rx = None
+
+        if cmd.startswith('+CGACT=1,'):
+            self.apn_next()
 
     def drain_resp(self):
         try:
             self.ser.timeout = 1
 
             while True:
-                line = self.ser.readline().strip().decode()
+                line = self.ser.readline().strip().decode(errors='replace')
                 if not line:
                     break
                 log.debug('< %s', line)
-        except:
-            self.error()
+        except serial.SerialException:
+            self.error('Read error')
         finally:
             self.ser.timeout = None
 
@@ -605,9 +1717,23 @@ class Modem(object):
             return
 
         while True:
-            if self.ready:
+            if self.ready and self.wdog_due:
+                self.wdog_due = False
+                self.send(self.wdog_cmd())
+            elif self.ready and self.wdog_held:
+                self.send(self.wdog_held)
+                self.wdog_held = None
+            elif self.ready:
                 try:
-                    self.send(self.cmds.get(False))
+                    cmd = self.next_cmd()
+
+                    if cmd.startswith('AT+CMGS='):
+                        # no edges can be sent until the message is
+                        # submitted, start with a full interval
+                        self.wdog_held = cmd
+                        self.send(self.wdog_cmd())
+                    else:
+                        self.send(cmd)
 
                     if self.cmds.empty() and self.running is None:
                         self.running = True
@@ -624,55 +1750,111 @@ class Modem(object):
                 self.error('Read error')
                 break
 
+            if line is None:
+                continue
+
+            if self.sms_rx is not None and self.sms_rx['need'] > 0:
+                log.debug('< %s', self.rawline)
+                self.sms_body()
+                continue
+
             if not line:
                 continue
 
-            log.debug('< %s' % line)
+            shown = mask_pin(line)
+            log.debug('< %s', shown)
 
-            if line.startswith('AT'):
-                if line != self.lastcmd:
-                    log.error('Unexpected command echo: %s' % line)
-                    log.error('Last command was: %s' % self.lastcmd)
-                    self.drain_resp()
-                    self.ready = True
+            kind, cmd, resp = parse_line(line, self.lastcmd)
+
+            if self.sms_sent:
+                # the modem echoes the message text, only the result of
+                # the send may complete the command
+                if line == self.sms_text:
+                    self.sms_text = None
                     continue
 
-            if line == 'ERROR' or line.startswith('+CME ERROR:'):
-                self.handle_error(self.lastcmd.lstrip('AT'), line)
-                self.ready = True
+                if line.startswith(('+CMGS:', '+CMS ERROR:')):
+                    self.sms_result = True
+                elif kind == LINE.OK:
+                    if not self.sms_result:
+                        continue
+                elif not line.startswith(SMS_URCS):
+                    continue
+
+                if kind == LINE.OK or kind == LINE.ERROR:
+                    self.sms_sent = False
+
+            if kind == LINE.OK:
+                self.evlog.add(EVENT.OK, self.cmd_log,
+                               time.monotonic() - self.cmd_time)
+            elif kind == LINE.ERROR:
+                self.evlog.add(EVENT.ERROR, '%s %s' % (self.cmd_log, line),
+                               time.monotonic() - self.cmd_time)
+            else:
+                self.evlog.add(EVENT.RESP, shown)
+
+            if line == '>' and self.sms_prompt:
+                self.sms_prompt = False
+                self.sms_sent = True
+                self.sms_result = False
+                text = self.sms_text.encode('ascii', 'replace')
+                # compared to the echo
+                self.sms_text = text.decode().strip()
+                try:
+                    self.ser.write(text + b'\x1a')
+                except serial.SerialException:
+                    self.error('Write error')
                 continue
 
-            if line == 'NO CARRIER' or line.startswith('+PPPD:'):
+            if kind == LINE.ECHO and line != self.lastcmd:
+                log.error('Unexpected command echo: %s', shown)
+                log.error('Last command was: %s', self.cmd_log)
+                self.drain_resp()
+                self.ready = True
                 continue
 
-            p = line.split(': ', 1)
+            if kind == LINE.ERROR:
+                self.handle_error(cmd, resp)
+                self.ready = True
+                continue
 
-            if len(p) == 1:
-                cmd = self.lastcmd.lstrip('AT')
-                resp = p[0]
-            else:
-                cmd = p[0]
-                resp = p[1]
+            if kind == LINE.IGNORE:
+                continue
 
             try:
-                if line == 'OK':
-                    self.handle_ok(cmd)
-                elif line.startswith('AT'):
-                    self.handle_echo(cmd)
+                if kind == LINE.OK:
+                    if ';' in cmd:
+                        self.pipeline_errors = 0
+                    for c in cmd.split(';'):
+                        self.handle_ok(c)
+                elif kind == LINE.ECHO:
+                    for c in cmd.split(';'):
+                        self.handle_echo(c)
                 else:
                     self.handle_resp(cmd, resp)
-            except:
+            except (ValueError, IndexError, KeyError):
+                # malformed response, not worth a traceback
+                log.warning('Bad response to %s: %s', self.cmd_log, shown)
+            except Exception:
                 log.warning(traceback.format_exc())
 
-            if line == 'OK':
+            if kind == LINE.OK:
                 self.ready = True
 
     def connect(self):
         if not self.ppp:
             log.info('Starting pppd')
-            make_authfile(AUTH_FILE,
-                          self.settings['user'],
-                          self.settings['passwd'])
+            self.evlog.add(EVENT.STATE, 'pppd start, cid %s' % self.pdp_cid)
+
+            user = self.conf('user')
+            passwd = self.conf('passwd')
+            cand = self.apn_current()
+
+            if cand and not user:
+                user = cand.user
+                passwd = cand.passwd
+
+            make_options(AUTH_FILE, user, passwd, self.pdp_type)
             make_chatscript(CHAT_SCRIPT, self.pdp_cid)
             ppp_service(True)
             self.ppp = True
@@ -681,6 +1863,7 @@ class Modem(object):
     def disconnect(self, force=False):
         if self.ppp or force:
             log.info('Stopping pppd')
+            self.evlog.add(EVENT.STATE, 'pppd stop')
             ppp_service(False)
             self.ppp = False
             self.ppp_time = None
@@ -705,29 +1888,69 @@ class Modem(object):
 
     def ppp_status(self):
         if not self.ppp:
-            return PPP_STATUS.DOWN
+            return PPP_STATUS.DOWN, False, False
 
-        if check_route(ipv6=False):
-            return PPP_STATUS.UP
+        ipv4 = check_route(ipv6=False)
+        ipv6 = check_route(ipv6=True)
 
-        if check_route(ipv6=True):
-            return PPP_STATUS.UP
+        if ipv4 or ipv6:
+            return PPP_STATUS.UP, ipv4, ipv6
 
-        return PPP_STATUS.INIT
+        return PPP_STATUS.INIT, False, False
 
     def check_ppp(self):
-        st = self.ppp_status()
+        st, ipv4, ipv6 = self.ppp_status()
+        ip6 = None
+
+        if ipv6:
+            ip6 = ppp_ipv6_addr()
+
+        if ip6 is None and self.pdp_ip6 is not None and \
+           not self.pdp_ip6.is_link_local:
+            ip6 = self.pdp_ip6
+
+        self.dbus['/IPv6'] = str(ip6) if ip6 is not None else None
+        self.dbus['/ConnectedIPv4'] = int(ipv4)
+        self.dbus['/ConnectedIPv6'] = int(ipv6)
+
+        if st != self.dbus['/PPPStatus']:
+            self.evlog.add(EVENT.STATE, 'PPPStatus %d' % st)
+            self.timeline.add(TIMELINE.PPP, st)
+
         self.dbus['/PPPStatus'] = st
         self.dbus['/Connected'] = int(st == PPP_STATUS.UP)
 
+        if st == PPP_STATUS.UP:
+            self.apn_save()
+
         if self.ppp_time is not None and st != PPP_STATUS.UP:
             if time.time() - self.ppp_time > PPP_TIMEOUT:
+                if self.apn_next():
+                    return
                 self.error('Timeout waiting for ppp')
 
     def setting_changed(self, setting, old, new):
         if not self.running:
             return
 
+        if setting.startswith('profile'):
+            prof, key = setting[7:].split('_', 1)
+
+            if key == 'iccid':
+                if self.select_profile() and self.registered:
+                    self.switch_pdp()
+                return
+
+            if key == 'name':
+                if int(prof) == self.profile:
+                    self.dbus['/Profile'] = new or prof
+                return
+
+            if int(prof) == self.profile and key in PROFILE_KEYS:
+                setting = key
+            else:
+                return
+
         if setting == 'connect' or setting == 'roaming':
             self.update_connection()
             return
@@ -737,9 +1960,19 @@ class Modem(object):
             return
 
         if setting == 'apn':
+            self.apn_cands = None
+            self.switch_pdp()
+            return
+
+        if setting == 'pdptype':
             self.select_pdp()
             return
 
+        if setting == 'pipeline':
+            self.pipeline = True
+            self.pipeline_errors = 0
+            return
+
         if setting == 'user' or setting == 'passwd':
             self.disconnect()
             self.update_connection()
@@ -762,19 +1995,44 @@ class Modem(object):
         self.dbus = VeDbusService('com.victronenergy.modem', register=False)
         self.dbus.add_path('/Model', None)
         self.dbus.add_path('/IMEI', None)
+        self.dbus.add_path('/ICCID', None)
+        self.dbus.add_path('/Profile', None)
         self.dbus.add_path('/NetworkName', None)
         self.dbus.add_path('/NetworkType', None)
         self.dbus.add_path('/SignalStrength', None)
         self.dbus.add_path('/Roaming', None)
         self.dbus.add_path('/Connected', None)
         self.dbus.add_path('/IP', None)
+        self.dbus.add_path('/IPv6', None)
+        self.dbus.add_path('/ConnectedIPv4', None)
+        self.dbus.add_path('/ConnectedIPv6', None)
         self.dbus.add_path('/SimStatus', None)
         self.dbus.add_path('/RegStatus', None)
         self.dbus.add_path('/PPPStatus', None)
+        self.dbus.add_path('/Watchdog/Feeds', 0)
+        self.dbus.add_path('/Watchdog/IntervalMin', None)
+        self.dbus.add_path('/Watchdog/IntervalMax', None)
+        self.dbus.add_path('/Watchdog/Jitter', None)
+        self.dbus.add_path('/Watchdog/Late', 0)
+        self.dbus.add_path('/Watchdog/Skipped', 0)
+        self.dbus.add_path('/Stats/Availability', None)
+        self.dbus.add_path('/Stats/MeanTimeToConnect', None)
+        self.dbus.add_path('/Stats/Reconnects', None)
         self.dbus.add_path('/Debug', self.debug, writeable=True,
                            onchangecallback=self.set_debug)
         self.dbus.register()
 
+        self.sms.load()
+        self.sms_export = SmsExport(self.dbus.dbusconn, '/Sms', self)
+        self.evlog_export = EventLogExport(self.dbus.dbusconn, '/EventLog',
+                                           self.evlog)
+
+        self.timeline.load()
+        # not /Stats, velib exports the tree of values below it there
+        self.stats_export = StatsExport(self.dbus.dbusconn, '/StatsQuery',
+                                        self.timeline)
+        self.update_stats()
+
         log.info('Waiting for localsettings')
         self.settings = SettingsDevice(self.dbus.dbusconn, modem_settings,
                                        self.setting_changed, timeout=10)
@@ -801,13 +2059,29 @@ class Modem(object):
     def update(self):
         if self.running:
             self.modem_update()
-            self.wdog_update()
             self.check_ppp()
         return True
 
+    def update_stats(self):
+        now = time.time()
+        st = self.timeline.stats(now - STATS_WINDOW, now)
+
+        avail = st.get('Availability')
+        ttc = st.get('MeanTimeToConnect')
+
+        self.dbus['/Stats/Availability'] = \
+            round(avail, 2) if avail is not None else None
+        self.dbus['/Stats/MeanTimeToConnect'] = \
+            round(ttc, 1) if ttc is not None else None
+        self.dbus['/Stats/Reconnects'] = st.get('Reconnects')
+
+        self.timeline.flush()
+
+        return True
+
 def quit(n):
     global start
-    log.info('End. Run time %s' % str(datetime.now() - start))
+    log.info('End. Run time %s', datetime.now() - start)
     ppp_service(False)
     os._exit(n)
 
@@ -832,6 +2106,9 @@ def main():
     logging.basicConfig(format='%(levelname)-8s %(message)s',
                         level=(logging.DEBUG if args.debug else logging.INFO))
 
+    # also covers debug logging enabled through /Debug
+    log.addFilter(RateLimit(DEBUG_RATE, DEBUG_BURST))
+
     logLevel = {
         0:  'NOTSET',
         10: 'DEBUG',
@@ -839,7 +2116,7 @@ def main():
         30: 'WARNING',
         40: 'ERROR',
     }
-    log.info('Loglevel set to ' + logLevel[log.getEffectiveLevel()])
+    log.info('Loglevel set to %s', logLevel[log.getEffectiveLevel()])
 
     if not args.serial:
         log.error('No serial port specified, see -h')
@@ -847,8 +2124,8 @@ def main():
 
     rate = 115200
 
-    log.info('Starting dbus-modem %s on %s at %d bps' %
-             (VERSION, args.serial, rate))
+    log.info('Starting dbus-modem %s on %s at %d bps',
+             VERSION, args.serial, rate)
 
     dbus.mainloop.glib.threads_init()
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
@@ -863,8 +2140,13 @@ def main():
         return
 
     GLib.timeout_add(5000, modem.update)
+    GLib.timeout_add(WDOG_INTERVAL * 1000, modem.wdog_update)
+    GLib.timeout_add(60000, modem.update_stats)
     mainloop.run()
 
+    modem.timeline.add(TIMELINE.PPP, PPP_STATUS.DOWN)
+    modem.timeline.flush(True)
+
     quit(1)
 
 if __name__ == '__main__':
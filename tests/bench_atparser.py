@@ -0,0 +1,41 @@
+#!/usr/bin/python3
+# Throughput of line classification and field splitting.
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from atparser import LINE, fields, parse_line
+from test_atparser import SAMPLES, garbled_lines
+
+def bench(name, lines, fn, number=20):
+    t = min(timeit.repeat(lambda: fn(lines), number=number, repeat=5))
+    n = len(lines) * number
+    print('%-24s %8.0f lines/s  %6.2f us/line' % (name, n / t, t / n * 1e6))
+
+def classify(lines):
+    for line in lines:
+        parse_line(line, 'AT+CSQ')
+
+def classify_split(lines):
+    for line in lines:
+        kind, cmd, resp = parse_line(line, 'AT+CSQ')
+        if kind == LINE.RESP:
+            try:
+                fields(resp)
+            except ValueError:
+                pass
+
+def main():
+    lines = SAMPLES * 100
+    garbled = list(garbled_lines(len(lines)))
+
+    bench('parse_line', lines, classify)
+    bench('parse_line garbled', garbled, classify)
+    bench('parse_line + fields', lines, classify_split)
+    bench('parse_line + fields bad', garbled, classify_split)
+
+if __name__ == '__main__':
+    main()
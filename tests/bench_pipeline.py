@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+# Status poll cost with and without pipelining, on a fake serial port.
+#
+# The time on the serial link is estimated from the bytes transferred
+# and a fixed turnaround per command line, the time from the modem
+# receiving a line to the first byte of its response.  Use -t to set
+# it to what is measured on a real link.
+
+from argparse import ArgumentParser
+import time
+
+import fakemodem
+from fakemodem import FakeSerial, Responder
+
+dm = fakemodem.load_daemon()
+
+MODELS = [
+    ('SIM7600E-H', fakemodem.RESPONSES),
+    ('SIM5360E', fakemodem.SIM5360E),
+]
+
+class CountingSerial(FakeSerial):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.tx = 0
+        self.rx = 0
+
+    def write(self, data):
+        self.tx += len(data)
+        super().write(data)
+
+    def read(self, n=1):
+        r = super().read(n)
+        self.rx += len(r)
+        return r
+
+def poll(responses, pipeline, polls):
+    m = fakemodem.make_modem(dm, None, pipeline=pipeline)
+    m.running = True
+    m.sim_status = dm.SIM_STATUS.READY
+
+    # the model decides the watchdog command
+    m.ser = FakeSerial(Responder(responses))
+    fakemodem.run(m, ['AT+CGMM'])
+
+    m.ser = CountingSerial(Responder(responses))
+    cpu = time.process_time()
+
+    # status poll and watchdog edge, both run every 5 seconds
+    for i in range(polls):
+        m.wdog_update()
+        m.modem_update()
+        fakemodem.run(m)
+
+    cpu = time.process_time() - cpu
+
+    return len(m.ser.written) / polls, (m.ser.tx + m.ser.rx) / polls, \
+        cpu / polls
+
+def main():
+    parser = ArgumentParser(description='pipelining benchmark')
+    parser.add_argument('-t', '--turnaround', type=float, default=20,
+                        help='modem turnaround per command line (ms)')
+    parser.add_argument('-b', '--baud', type=int, default=115200)
+    parser.add_argument('-n', '--polls', type=int, default=200)
+    args = parser.parse_args()
+
+    print('turnaround %g ms, %d bps, %d polls' %
+          (args.turnaround, args.baud, args.polls))
+    print('%-10s %-10s %6s %7s %10s %10s' %
+          ('model', '', 'lines', 'bytes', 'link (ms)', 'cpu (ms)'))
+
+    for model, responses in MODELS:
+        for pipeline in [0, 1]:
+            lines, nbytes, cpu = poll(responses, pipeline, args.polls)
+            link = lines * args.turnaround + nbytes * 10 / args.baud * 1000
+            print('%-10s %-10s %6.1f %7.0f %10.1f %10.2f' %
+                  (model, 'pipeline' if pipeline else 'single', lines,
+                   nbytes, link, cpu * 1000))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+# Run the daemon against a simulated modem.
+#
+# The daemon needs D-Bus, GLib, pyserial and velib.  Those that are not
+# installed are replaced by minimal stand-ins so the module can be
+# imported.  Nothing here talks to a real bus or serial port.
+
+import collections
+import importlib.util
+import os
+import queue
+import sys
+import tempfile
+import types
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, 'ext', 'velib_python'))
+
+def _module(name, **attrs):
+    mod = types.ModuleType(name)
+    mod.__dict__.update(attrs)
+    sys.modules[name] = mod
+
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, mod)
+
+    return mod
+
+def _decorator(*args, **kwargs):
+    return lambda f: f
+
+def install_stubs():
+    try:
+        import serial
+    except ImportError:
+        _module('serial', Serial=object,
+                SerialException=type('SerialException', (IOError,), {}))
+
+    try:
+        import dbus.service
+        import dbus.mainloop.glib
+    except ImportError:
+        _module('dbus', SessionBus=object, SystemBus=object)
+        _module('dbus.service', Object=object, method=_decorator,
+                signal=_decorator)
+        _module('dbus.mainloop')
+        _module('dbus.mainloop.glib', DBusGMainLoop=object)
+
+    try:
+        from gi.repository import GLib
+    except ImportError:
+        _module('gi')
+        _module('gi.repository', GLib=None)
+
+    try:
+        import vedbus
+    except ImportError:
+        _module('vedbus', VeDbusService=object)
+
+    try:
+        import settingsdevice
+    except ImportError:
+        _module('settingsdevice', SettingsDevice=object)
+
+    # the daemon runs on Python 3.13 or later
+    if not hasattr(queue, 'ShutDown'):
+        queue.ShutDown = type('ShutDown', (Exception,), {})
+
+def load_daemon():
+    if 'dbus_modem' in sys.modules:
+        return sys.modules['dbus_modem']
+
+    install_stubs()
+
+    spec = importlib.util.spec_from_file_location(
+        'dbus_modem', os.path.join(ROOT, 'dbus-modem.py'))
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules['dbus_modem'] = mod
+    spec.loader.exec_module(mod)
+
+    # keep files written by the daemon out of the system directories
+    tmp = tempfile.mkdtemp(prefix='dbus-modem-test-')
+    mod.CHAT_SCRIPT = os.path.join(tmp, 'chat')
+    mod.AUTH_FILE = os.path.join(tmp, 'auth')
+    mod.EVLOG_FILE = os.path.join(tmp, 'events.log')
+    mod.ppp_service = lambda up: None
+
+    return mod
+
+# responses of a registered SIM7600 with an active data context
+RESPONSES = {
+    'AT+CGMM': ['SIMCOM_SIM7600E-H'],
+    'AT+CGSN': ['861234567890123'],
+    'AT+CICCID': ['+ICCID: 8931440400012345678F'],
+    'AT+CIMI': ['204080123456789'],
+    'AT+CPIN?': ['+CPIN: READY'],
+    'AT+CGPS?': ['+CGPS: 0,1'],
+    'AT+COPS?': ['+COPS: 0,0,"vodafone NL",7'],
+    'AT+CNSMOD?': ['+CNSMOD: 0,8'],
+    'AT+CSQ': ['+CSQ: 20,99'],
+    'AT+CGACT?': ['+CGACT: 1,1'],
+    'AT+CGATT?': ['+CGATT: 1'],
+    'AT+CREG?': ['+CREG: 0,1'],
+    'AT+CGPADDR': ['+CGPADDR: 1,"10.64.1.2"'],
+    'AT+CGDCONT?': ['+CGDCONT: 1,"IP","internet","0.0.0.0",0,0,0,0'],
+}
+
+# a SIM5360E on UMTS, the model with a save flag in GPIO commands
+SIM5360E = dict(RESPONSES, **{
+    'AT+CGMM': ['SIMCOM_SIM5360E'],
+    'AT+COPS?': ['+COPS: 0,0,"vodafone NL",2'],
+    'AT+CNSMOD?': ['+CNSMOD: 0,7'],
+    'AT+CGPADDR': ['+CGPADDR: 1,10.64.1.2'],
+})
+
+class Responder(object):
+    # Commands on one line are answered in order, ending with a single
+    # OK, or ERROR at the first command listed in fail.
+
+    def __init__(self, responses=RESPONSES, fail=()):
+        self.responses = responses
+        self.fail = fail
+
+    def __call__(self, cmd):
+        lines = []
+
+        for i, c in enumerate(cmd.split(';')):
+            c = 'AT' + c if i else c
+            if c in self.fail:
+                return lines + ['+CME ERROR: 4']
+            lines += self.responses.get(c, [])
+
+        return lines + ['OK']
+
+class Desync(AssertionError):
+    pass
+
+class FakeSerial(object):
+    """Serial port with a modem behind it.
+
+    Commands written are echoed and answered by respond(cmd), which
+    returns the lines to send, ending with the final result.  Lines from
+    noise() are sent before the final result.  Reading with nothing
+    left to read raises SerialException, which stops Modem.run().
+
+    A command written while the final result of the previous one has
+    not been read means some other line completed it, this raises
+    Desync.
+    """
+
+    def __init__(self, respond, noise=None):
+        self.respond = respond
+        self.noise = noise or (lambda cmd: [])
+        self.out = bytearray()
+        self.final = 0
+        self.timeout = None
+        self.written = []
+        self.sms = None
+        self.sms_sent = []
+
+    def emit(self, line, final=False):
+        data = b'\r\n' + line.encode() + b'\r\n'
+        if final:
+            self.final = len(self.out) + len(data)
+        self.out += data
+
+    def answer(self, cmd, lines):
+        for line in lines[:-1]:
+            self.emit(line)
+        for line in self.noise(cmd):
+            self.emit(line)
+        self.emit(lines[-1], final=True)
+
+    def write(self, data):
+        if self.sms is not None:
+            # message text, the modem echoes it before the result
+            text = bytes(data).rstrip(b'\x1a').decode()
+            self.sms_sent.append((self.sms, text))
+            self.out += text.encode() + b'\r\n'
+            self.answer(self.sms, ['+CMGS: %d' % len(self.sms_sent), 'OK'])
+            self.sms = None
+            return
+
+        if self.final > 0:
+            raise Desync('%r written before the result of %r was read' %
+                         (bytes(data), self.written[-1]))
+
+        for cmd in bytes(data).decode().split('\r'):
+            if not cmd:
+                continue
+
+            self.written.append(cmd)
+            self.out += cmd.encode() + b'\r'
+
+            if cmd.startswith('AT+CMGS='):
+                self.sms = cmd
+                self.out += b'\r\n> '
+                continue
+
+            self.answer(cmd, self.respond(cmd))
+
+    def read(self, n=1):
+        if not self.out:
+            import serial
+            raise serial.SerialException('no more data')
+
+        r = bytes(self.out[:n])
+        del self.out[:n]
+        self.final -= n
+
+        return r
+
+    def readline(self):
+        i = self.out.find(b'\n')
+        if i < 0:
+            return self.read(len(self.out)) if self.out else b''
+        return self.read(i + 1)
+
+    def cancel_read(self):
+        pass
+
+    def close(self):
+        pass
+
+class Settings(dict):
+    def addSetting(self, *args):
+        pass
+
+def make_modem(dm, respond, noise=None, **settings):
+    m = dm.Modem('/dev/null', 115200)
+
+    m.ser = FakeSerial(respond, noise)
+    m.dbus = collections.defaultdict(lambda: None)
+    m.settings = Settings({k: v[1] for k, v in dm.modem_settings.items()})
+    m.settings.update(settings)
+    m.timeline = dm.Timeline(os.path.join(tempfile.mkdtemp(), 'timeline'))
+    m.sms = dm.SmsStore(tempfile.mkdtemp(), dm.SMS_MAX)
+    m.errors = []
+    m.error = m.errors.append
+    m.modem_wait = lambda: True
+    m.ready = True
+
+    return m
+
+def run(m, cmds=()):
+    m.cmd(cmds)
+    m.run()
+
+    if m.ser.out:
+        raise Desync('unread data: %r' % bytes(m.ser.out))
+
+    return m
@@ -0,0 +1,79 @@
+import mmap
+import os
+import tempfile
+import unittest
+
+import fakemodem
+
+dm = fakemodem.load_daemon()
+
+DB = '''\
+# comment
+#20404\tcommented
+20404\tlive.vodafone.com\t\t
+20408\tKPN4G.nl\t\t
+20408\tinternet\t\t
+20409
+21401\tairtelnet.es\tvodafone\tvodafone
+31026\tshort
+310260\tfast.t-mobile.com
+310410\tphone
+'''
+
+class ApnDbTest(unittest.TestCase):
+    def setUp(self):
+        fd, self.name = tempfile.mkstemp()
+        with os.fdopen(fd, 'w') as f:
+            f.write(DB)
+        self.addCleanup(os.remove, self.name)
+        self.db = dm.ApnDb(self.name)
+
+    def search(self, key):
+        with open(self.name, 'rb') as f, \
+             mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            return dm.ApnDb.search(m, key.encode())
+
+    def test_search(self):
+        self.assertEqual(self.search('20404'),
+                         [dm.ApnEntry('live.vodafone.com')])
+        self.assertEqual(self.search('20408'),
+                         [dm.ApnEntry('KPN4G.nl'), dm.ApnEntry('internet')])
+        self.assertEqual(self.search('21401'),
+                         [dm.ApnEntry('airtelnet.es', 'vodafone', 'vodafone')])
+
+    def test_not_found(self):
+        for key in ['#', '00000', '20405', '99999', '3102600']:
+            self.assertEqual(self.search(key), [])
+
+    def test_short_line(self):
+        self.assertEqual(self.search('20409'), [])
+
+    def test_lookup(self):
+        # 3 digit MNC first
+        self.assertEqual(self.db.lookup('310260123456789'),
+                         ('310260', [dm.ApnEntry('fast.t-mobile.com')]))
+        self.assertEqual(self.db.lookup('310261123456789'),
+                         ('31026', [dm.ApnEntry('short')]))
+        self.assertEqual(self.db.lookup('204080123456789')[0], '20408')
+        self.assertEqual(self.db.lookup('204990123456789'), ('20499', []))
+
+    def test_missing(self):
+        db = dm.ApnDb(self.name + '.missing')
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(db.lookup('204080123456789'), ('20408', []))
+
+    def test_shipped(self):
+        db = dm.ApnDb(os.path.join(fakemodem.ROOT, 'apn.txt'))
+
+        with open(db.name) as f:
+            keys = [l.split('\t', 1)[0] for l in f if not l.startswith('#')]
+        self.assertEqual(keys, sorted(keys))
+
+        for key in set(keys):
+            mccmnc, entries = db.lookup(key + '0123456789')
+            self.assertEqual(mccmnc, key)
+            self.assertTrue(entries)
+            self.assertFalse(any('wap' in e.apn for e in entries))
+
+if __name__ == '__main__':
+    unittest.main()
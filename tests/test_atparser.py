@@ -0,0 +1,167 @@
+import random
+import unittest
+
+from atparser import LINE, LINE_MAX, PDPContext, ParseError, fields, \
+    parse_line, parse_pdp_addr
+
+# lines as sent by the supported modems
+SAMPLES = [
+    'OK',
+    'ERROR',
+    '+CME ERROR: 10',
+    '+CMS ERROR: 500',
+    'AT+CSQ',
+    'AT+COPS?;+CSQ;+CGPADDR',
+    'NO CARRIER',
+    '+PPPD: DISCONNECTED',
+    'RDY',
+    '+CPIN: READY',
+    '+CPIN: SIM PIN',
+    '+CGMM: SIMCOM_SIM7600E-H',
+    '+ICCID: 8931440400012345678F',
+    '+CREG: 0,1',
+    '+CREG: 5',
+    '+COPS: 0,0,"vodafone NL",7',
+    '+CNSMOD: 0,8',
+    '+CSQ: 20,99',
+    '+CGACT: 1,1',
+    '+CGATT: 1',
+    '+CGDCONT: 1,"IPV4V6","internet","0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0",'
+    '0,0,0,0,,,,',
+    '+CGPADDR: 1,"10.64.1.2","32.1.13.184.0.0.0.0.0.0.0.0.0.0.0.1"',
+    '+CGPADDR: 1,10.64.1.2 2001:db8::1',
+    '+CMTI: "SM",3',
+    '+CMGS: 12',
+    '+CMGR: "REC UNREAD","+31612345678","","26/10/19,10:00:00+08",145,4,0,'
+    '0,"+31653131313",145,5',
+    '+CMGL: 1,"REC UNREAD","+31612345678","","26/10/19,10:00:00+08",145,5',
+    '+CGPS: 1,1',
+]
+
+NOISE = '\x00\ufffd,": ;"+0123456789.AT'
+
+def garble(rnd, line):
+    op = rnd.randrange(6)
+
+    if op == 0:
+        # truncated by a reset or a full buffer
+        return line[:rnd.randrange(len(line) + 1)]
+
+    if op == 1:
+        # unsolicited result interleaved with a response
+        i = rnd.randrange(len(line) + 1)
+        return line[:i] + rnd.choice(SAMPLES) + line[i:]
+
+    if op == 2:
+        # line noise
+        s = list(line)
+        for _ in range(rnd.randrange(1, 5)):
+            s.insert(rnd.randrange(len(s) + 1), rnd.choice(NOISE))
+        return ''.join(s)
+
+    if op == 3:
+        # bytes read from a babbling link
+        raw = bytes(rnd.randrange(256) for _ in range(rnd.randrange(40)))
+        return raw.decode(errors='replace').strip()
+
+    if op == 4:
+        return line * rnd.randrange(1, 4)
+
+    return line
+
+def garbled_lines(n, seed=1):
+    rnd = random.Random(seed)
+    for _ in range(n):
+        yield garble(rnd, rnd.choice(SAMPLES))[:LINE_MAX]
+
+class ParseLineTest(unittest.TestCase):
+    def test_results(self):
+        self.assertEqual(parse_line('OK', 'AT+CSQ'), (LINE.OK, '+CSQ', 'OK'))
+        self.assertEqual(parse_line('+CME ERROR: 10', 'AT+CPIN?'),
+                         (LINE.ERROR, '+CPIN?', '+CME ERROR: 10'))
+        self.assertEqual(parse_line('OK', None), (LINE.OK, '', 'OK'))
+
+    def test_echo(self):
+        self.assertEqual(parse_line('AT+CSQ', 'AT+CSQ'),
+                         (LINE.ECHO, '+CSQ', 'AT+CSQ'))
+
+    def test_response(self):
+        self.assertEqual(parse_line('+CSQ: 20,99', 'AT+CSQ'),
+                         (LINE.RESP, '+CSQ', '20,99'))
+        self.assertEqual(parse_line('SIMCOM_SIM7600E-H', 'AT+CGMM'),
+                         (LINE.RESP, '+CGMM', 'SIMCOM_SIM7600E-H'))
+
+    def test_ignore(self):
+        self.assertEqual(parse_line('NO CARRIER', 'AT')[0], LINE.IGNORE)
+        self.assertEqual(parse_line('+PPPD: DISCONNECTED', 'AT')[0],
+                         LINE.IGNORE)
+
+    def test_garbled(self):
+        for line in garbled_lines(20000):
+            kind, cmd, resp = parse_line(line, 'AT+CSQ')
+            self.assertIsInstance(kind, LINE)
+            self.assertIsInstance(resp, str)
+
+            if kind != LINE.IGNORE:
+                self.assertIsInstance(cmd, str)
+
+class FieldsTest(unittest.TestCase):
+    def test_quoted(self):
+        self.assertEqual(fields('0,0,"a, b",7'), ['0', '0', 'a, b', '7'])
+        self.assertEqual(fields(''), [])
+
+    def test_garbled(self):
+        for line in garbled_lines(20000, 2):
+            try:
+                v = fields(line)
+            except ParseError:
+                continue
+            self.assertIsInstance(v, list)
+
+class PdpAddrTest(unittest.TestCase):
+    def test_dual_stack(self):
+        ip4, ip6 = parse_pdp_addr(['1', '10.64.1.2',
+                                   '32.1.13.184.0.0.0.0.0.0.0.0.0.0.0.1'])
+        self.assertEqual(str(ip4), '10.64.1.2')
+        self.assertEqual(str(ip6), '2001:db8::1')
+
+        ip4, ip6 = parse_pdp_addr(['1', '10.64.1.2 2001:db8::1'])
+        self.assertEqual(str(ip4), '10.64.1.2')
+        self.assertEqual(str(ip6), '2001:db8::1')
+
+    def test_unassigned(self):
+        self.assertEqual(parse_pdp_addr(['1', '0.0.0.0']), (None, None))
+        self.assertEqual(parse_pdp_addr([]), (None, None))
+
+    def test_garbled(self):
+        for line in garbled_lines(20000, 3):
+            try:
+                v = fields(line)
+            except ParseError:
+                continue
+            ip4, ip6 = parse_pdp_addr(v)
+            self.assertTrue(ip4 is None or ip4.version == 4)
+            self.assertTrue(ip6 is None or ip6.version == 6)
+
+class PDPContextTest(unittest.TestCase):
+    def test_create(self):
+        ctx = PDPContext.create('1', 'IP', 'internet', '', '0', '0', '0',
+                                '0', '', '', '')
+        self.assertEqual(ctx, PDPContext(1, 'IP', 'internet'))
+
+        ctx = PDPContext.create('2', 'IPV6', 'web')
+        self.assertEqual(ctx.cid, 2)
+        self.assertEqual(ctx.emergency, 0)
+
+    def test_short(self):
+        self.assertRaises(ParseError, PDPContext.create, '1', 'IP')
+
+    def test_garbled(self):
+        for line in garbled_lines(20000, 4):
+            try:
+                PDPContext.create(*fields(line))
+            except ValueError:
+                pass
+
+if __name__ == '__main__':
+    unittest.main()
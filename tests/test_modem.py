@@ -0,0 +1,449 @@
+import collections
+import logging
+import os
+import random
+import types
+import unittest
+from unittest import mock
+
+import fakemodem
+from atparser import LINE, parse_line
+from test_atparser import SAMPLES, garbled_lines
+
+dm = fakemodem.load_daemon()
+
+# responses only sent when asked for
+SOLICITED = ('+CMGR', '+CMGL')
+
+def noise_lines(n, seed):
+    # garbled lines that are not a command echo or final result, and
+    # so must never complete a command
+    lines = []
+
+    for line in garbled_lines(n, seed):
+        kind, cmd, resp = parse_line(line, None)
+        if line and kind in (LINE.RESP, LINE.IGNORE) and \
+           not line.startswith(SOLICITED):
+            lines.append(line)
+
+    return lines
+
+class Completions(object):
+    # count the commands completed by an OK or error
+
+    def __init__(self, m):
+        self.count = collections.Counter()
+        self.add = m.evlog.add
+        m.evlog.add = self
+
+    def __call__(self, kind, data, latency=0.0):
+        self.count[kind] += 1
+        self.add(kind, data, latency)
+
+    def total(self):
+        return self.count[dm.EVENT.OK] + self.count[dm.EVENT.ERROR]
+
+def make_modem(respond=None, noise=None, **settings):
+    m = fakemodem.make_modem(dm, respond or fakemodem.Responder(), noise,
+                             **settings)
+    m.completions = Completions(m)
+    return m
+
+def startup(m):
+    m.modem_init()
+    fakemodem.run(m)
+
+    # the data context is selected once registered
+    for i in range(2):
+        m.modem_update()
+        fakemodem.run(m)
+
+    return m
+
+class ModemTest(unittest.TestCase):
+    def check(self, m):
+        # every command written got exactly one final result
+        self.assertEqual(m.completions.total(), len(m.ser.written))
+        self.assertTrue(m.ready)
+
+class HandleRespTest(unittest.TestCase):
+    def test_garbled(self):
+        m = make_modem()
+        m.running = True
+
+        prefixes = sorted({parse_line(s, None)[1] for s in SAMPLES} - {None})
+        rnd = random.Random(5)
+
+        for n, line in enumerate(garbled_lines(20000, 5)):
+            kind, cmd, resp = parse_line(line, 'AT+CSQ')
+
+            for c in [cmd, rnd.choice(prefixes)]:
+                try:
+                    m.handle_resp(c, resp)
+                except (ValueError, IndexError, KeyError):
+                    pass
+
+            if n % 100 == 0:
+                m.cmds = dm.queue.PriorityQueue()
+
+class RunTest(ModemTest):
+    def test_startup(self):
+        m = startup(make_modem())
+
+        self.assertEqual(m.dbus['/Model'], 'SIMCOM_SIM7600E-H')
+        self.assertEqual(m.dbus['/RegStatus'], dm.REG_STATUS.HOME)
+        self.assertEqual(m.dbus['/SignalStrength'], 20)
+        self.check(m)
+
+    def test_noise(self):
+        for seed in range(10):
+            noise = noise_lines(2000, seed)
+            rnd = random.Random(seed)
+            m = make_modem(noise=lambda cmd: rnd.sample(noise, 3))
+
+            m.sim_status = dm.SIM_STATUS.READY
+            m.sms_send('+31612345678', 'status')
+            startup(m)
+
+            self.check(m)
+
+class SmsTest(ModemTest):
+    CMGR = '+CMGR: "REC UNREAD","+31612345678","","26/10/19,10:00:00+08",' \
+        '145,4,0,0,"+31653131313",145,%d'
+
+    def test_send_echo(self):
+        # text that looks like a result is echoed by the modem
+        m = make_modem()
+        m.sim_status = dm.SIM_STATUS.READY
+
+        texts = ['ERROR', 'OK', '+CME ERROR: 3', 'AT+CFUN=0', '+CREG: 5']
+        for text in texts:
+            self.assertTrue(m.sms_send('+31612345678', text))
+
+        fakemodem.run(m, ['AT+CSQ'])
+
+        self.assertEqual([t for c, t in m.ser.sms_sent], texts)
+        self.assertIsNone(m.dbus['/RegStatus'])
+        self.check(m)
+
+    def test_urc_during_send(self):
+        m = make_modem(fakemodem.Responder({
+            'AT+CMGR=7': [self.CMGR % 2 + '\r\nhi'],
+        }), noise=lambda cmd: ['+CMTI: "SM",7', '+CREG: 1']
+            if cmd.startswith('AT+CMGS=') else [])
+        m.sim_status = dm.SIM_STATUS.READY
+
+        m.sms_send('+31612345678', 'status')
+        fakemodem.run(m)
+
+        self.assertIn('AT+CMGR=7', m.ser.written)
+        self.assertEqual(m.sms.list()[0]['text'], 'hi')
+        self.assertEqual(m.dbus['/RegStatus'], dm.REG_STATUS.HOME)
+        self.check(m)
+
+    def test_receive(self):
+        body = 'OK\r\n+CREG: 5'
+
+        m = make_modem(fakemodem.Responder({
+            'AT+CMGR=3': [self.CMGR % 12 + '\r\n' + body],
+        }), noise=lambda cmd: ['+CREG: 1'])
+
+        m.handle_resp('+CMTI', '"SM",3')
+        fakemodem.run(m)
+
+        msg = m.sms.list()[0]
+        self.assertEqual(msg['text'], 'OK\n+CREG: 5')
+        self.assertEqual(m.dbus['/RegStatus'], dm.REG_STATUS.HOME)
+        self.check(m)
+
+    def test_list(self):
+        cmgl = '+CMGL: %d,"REC UNREAD","+31612345678","",' \
+            '"26/10/19,10:00:00+08",145,%d'
+
+        m = make_modem(fakemodem.Responder({
+            'AT+CMGL="REC UNREAD"': [cmgl % (1, 2) + '\r\nOK',
+                                     cmgl % (2, 12) + '\r\nfirst\nsecond'],
+        }))
+        m.sim_status = dm.SIM_STATUS.READY
+
+        m.sms_init()
+        fakemodem.run(m)
+
+        self.assertIn('AT+CSDH=1', m.ser.written)
+        self.assertEqual(sorted(msg['text'] for msg in m.sms.list()),
+                         ['OK', 'first\nsecond'])
+        self.check(m)
+
+class WatchdogTest(ModemTest):
+    def setUp(self):
+        self.now = 1000.0
+        patch = mock.patch.object(dm.time, 'monotonic', lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.m = make_modem()
+        self.m.running = True
+
+    def feed(self, t):
+        self.now += t
+        self.m.wdog_update()
+        fakemodem.run(self.m)
+
+    def test_setup_not_counted(self):
+        m = self.m
+
+        m.wdog_init()
+        fakemodem.run(m)
+
+        self.assertEqual(m.wdog_feeds, 0)
+        self.assertIsNone(m.wdog_last)
+        self.check(m)
+
+    def test_intervals(self):
+        m = self.m
+
+        for t in [0, 5, 35, 5]:
+            self.feed(t)
+
+        self.assertEqual(m.wdog_feeds, 4)
+        self.assertEqual(m.dbus['/Watchdog/IntervalMin'], 5)
+        self.assertEqual(m.dbus['/Watchdog/IntervalMax'], 35)
+        self.assertEqual(m.dbus['/Watchdog/Late'], 1)
+        self.assertAlmostEqual(m.wdog_jitter, 30 / 16 * 15 / 16)
+        self.assertEqual(m.ser.written, ['AT+CGSETV=44,0', 'AT+CGSETV=44,1',
+                                         'AT+CGSETV=44,0', 'AT+CGSETV=44,1'])
+        self.check(m)
+
+    def stall(self, cmd, t):
+        m = self.m
+        m.lastcmd = cmd
+        m.cmd_time = self.now - t
+        m.ready = False
+        m.wdog_update()
+
+    def test_stall(self):
+        m = self.m
+
+        with self.assertLogs(level='ERROR') as logs:
+            for i in range(3):
+                self.stall('AT+CSQ', dm.WDOG_STALL + 1)
+
+            self.assertFalse(m.wdog_due)
+            self.assertEqual(m.dbus['/Watchdog/Skipped'], 3)
+
+            m.ready = True
+            m.wdog_update()
+            self.assertTrue(m.wdog_due)
+            self.assertFalse(m.wdog_stalled)
+
+            self.stall('AT+CSQ', dm.WDOG_STALL + 1)
+
+        # logged once for each episode
+        self.assertEqual(len(logs.records), 2)
+
+    def test_sms_send(self):
+        m = self.m
+
+        self.stall('AT+CMGS="+31612345678"', dm.WDOG_STALL + 1)
+        self.assertTrue(m.wdog_due)
+        self.assertFalse(m.wdog_stalled)
+
+        self.stall('AT+CMGS="+31612345678"', dm.WDOG_STALL_CMGS + 1)
+        self.assertTrue(m.wdog_stalled)
+
+    def test_feed_before_sms(self):
+        m = self.m
+        m.sim_status = dm.SIM_STATUS.READY
+
+        m.sms_send('+31612345678', 'status')
+        fakemodem.run(m)
+
+        self.assertEqual(m.ser.written,
+                         ['AT+CGSETV=44,0', 'AT+CMGS="+31612345678"'])
+        self.assertEqual(m.wdog_feeds, 1)
+        self.check(m)
+
+class PipelineTest(ModemTest):
+    POLL = 'AT+COPS?;+CNSMOD?;+CSQ;+CGACT?;+CGATT?;+CREG?;+CGPADDR'
+
+    def poll(self, m):
+        m.modem_update()
+        fakemodem.run(m)
+
+    def test_models(self):
+        for responses in [fakemodem.RESPONSES, fakemodem.SIM5360E]:
+            m = startup(make_modem(fakemodem.Responder(responses),
+                                   pipeline=1))
+
+            self.assertIn(self.POLL, m.ser.written)
+            self.assertEqual(str(m.dbus['/IP']), '10.64.1.2')
+            self.check(m)
+
+    def test_transient_error(self):
+        respond = fakemodem.Responder()
+        fail = fakemodem.Responder(fail=['AT+CGATT?'])
+        calls = []
+
+        def once(cmd):
+            calls.append(cmd)
+            return (fail if cmd == self.POLL and calls.count(cmd) == 1
+                    else respond)(cmd)
+
+        m = startup(make_modem(once, pipeline=1))
+        self.poll(m)
+
+        # repeated as single commands, then combined again
+        self.assertIn('AT+CGATT?', m.ser.written)
+        self.assertEqual(m.ser.written.count(self.POLL), 3)
+        self.assertTrue(m.pipeline)
+        self.assertEqual(m.pipeline_errors, 0)
+        self.check(m)
+
+    def test_disabled(self):
+        m = startup(make_modem(fakemodem.Responder(fail=['AT+CGATT?']),
+                               pipeline=1))
+        m.running = True
+        self.poll(m)
+
+        self.assertFalse(m.pipeline)
+        self.assertEqual(m.ser.written.count(self.POLL), dm.PIPELINE_ERRORS)
+
+        n = len(m.ser.written)
+        self.poll(m)
+        self.assertNotIn(self.POLL, m.ser.written[n:])
+        self.check(m)
+
+        # changing the setting tries again
+        m.setting_changed('pipeline', 1, 1)
+        self.assertTrue(m.pipeline)
+        self.assertEqual(m.pipeline_errors, 0)
+
+class ProfileTest(ModemTest):
+    # a second context defined for another APN
+    RESPONSES = dict(fakemodem.RESPONSES, **{
+        'AT+CGDCONT?': ['+CGDCONT: 1,"IP","internet","0.0.0.0",0,0,0,0',
+                        '+CGDCONT: 2,"IPV4V6","web","0.0.0.0",0,0,0,0'],
+    })
+
+    def make_modem(self, **settings):
+        return make_modem(fakemodem.Responder(self.RESPONSES), **settings)
+
+    def test_select(self):
+        m = startup(self.make_modem(profile2_iccid='893144',
+                                    profile2_name='Work',
+                                    profile2_apn='web',
+                                    profile3_iccid='8931'))
+
+        self.assertEqual(m.profile, 2)
+        self.assertEqual(m.dbus['/Profile'], 'Work')
+        self.assertEqual(m.conf('apn'), 'web')
+        self.assertEqual(m.pdp_cid, 2)
+        self.check(m)
+
+    def test_switch_existing(self):
+        m = startup(self.make_modem(apn='internet'))
+        m.running = True
+        self.assertIsNone(m.profile)
+        self.assertEqual(m.pdp_cid, 1)
+
+        m.settings['profile1_iccid'] = '8931440400012345678'
+        m.settings['profile1_apn'] = 'web'
+        n = len(m.ser.written)
+
+        m.setting_changed('profile1_iccid', '', '8931440400012345678')
+        fakemodem.run(m)
+
+        # the context is reused without detaching or redefining it
+        self.assertEqual(m.profile, 1)
+        self.assertEqual(m.dbus['/Profile'], '1')
+        self.assertEqual(m.pdp_cid, 2)
+        self.assertEqual(m.pdp_type, 'IPV4V6')
+        self.assertEqual(m.ser.written[n:n + 3],
+                         ['AT+CGACT?', 'AT+CGATT=1', 'AT+CGATT?'])
+        self.assertNotIn('AT+CGATT=0', m.ser.written[n:])
+        self.assertFalse(any(c.startswith('AT+CGDCONT=')
+                             for c in m.ser.written[n:]))
+        self.check(m)
+
+    def test_rename(self):
+        m = startup(self.make_modem(profile1_iccid='893144',
+                                    profile1_name='Work'))
+        m.running = True
+
+        m.settings['profile1_name'] = 'Boat'
+        m.setting_changed('profile1_name', 'Work', 'Boat')
+        self.assertEqual(m.dbus['/Profile'], 'Boat')
+
+        m.settings['profile1_name'] = ''
+        m.setting_changed('profile1_name', 'Boat', '')
+        self.assertEqual(m.dbus['/Profile'], '1')
+
+        # not the active profile
+        m.setting_changed('profile2_name', '', 'Other')
+        self.assertEqual(m.dbus['/Profile'], '1')
+
+class EventLogTest(ModemTest):
+    def test_pin_masked(self):
+        m = make_modem(fakemodem.Responder(fail=['AT+CPIN=1234']))
+
+        with self.assertLogs(level='DEBUG') as logs:
+            fakemodem.run(m, ['AT+CPIN=1234'])
+
+        log = '\n'.join(m.evlog.format())
+        self.assertIn('AT+CPIN=****', log)
+        self.assertNotIn('1234', log)
+        self.assertNotIn('1234', '\n'.join(logs.output))
+        self.check(m)
+
+    def test_save_name(self):
+        export = types.SimpleNamespace(evlog=dm.EventLog(16))
+        save = dm.EventLogExport.Save
+        path = os.path.dirname(dm.EVLOG_FILE)
+
+        for name in ['/etc/passwd', '../passwd', 'sms/x', '.hidden']:
+            self.assertFalse(save(export, name))
+
+        self.assertTrue(save(export, 'saved.log'))
+        self.assertTrue(os.path.exists(os.path.join(path, 'saved.log')))
+        self.assertTrue(save(export, ''))
+        self.assertTrue(os.path.exists(dm.EVLOG_FILE))
+
+class OptionsTest(unittest.TestCase):
+    def options(self, *args):
+        dm.make_options(dm.AUTH_FILE, *args)
+        with open(dm.AUTH_FILE) as f:
+            return f.read().split('\n')[:-1]
+
+    def test_pdp_type(self):
+        self.assertEqual(self.options('', '', 'IP'), [])
+        self.assertEqual(self.options('web', 'pw', 'IPV4V6'),
+                         ['user web', 'password pw', '+ipv6'])
+        self.assertEqual(self.options('', '', 'IPV6'), ['+ipv6', 'noip'])
+
+class RateLimitTest(unittest.TestCase):
+    def record(self, level):
+        return logging.LogRecord('', level, '', 0, 'line %d', (1,), None)
+
+    def test_limit(self):
+        now = [0.0]
+
+        with mock.patch.object(dm.time, 'monotonic', lambda: now[0]):
+            f = dm.RateLimit(10, 20)
+
+            passed = sum(f.filter(self.record(logging.DEBUG))
+                         for i in range(100))
+            self.assertEqual(passed, 20)
+
+            # other levels are never dropped
+            self.assertTrue(f.filter(self.record(logging.INFO)))
+
+            now[0] += 1
+            passed = [r for r in (self.record(logging.DEBUG)
+                                  for i in range(100)) if f.filter(r)]
+
+        self.assertEqual(len(passed), 10)
+        self.assertEqual(passed[0].getMessage(),
+                         '[80 debug messages dropped] line 1')
+
+if __name__ == '__main__':
+    unittest.main()
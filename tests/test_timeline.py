@@ -0,0 +1,120 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import fakemodem
+
+dm = fakemodem.load_daemon()
+
+START = dm.TIMELINE.START
+PPP = dm.TIMELINE.PPP
+REG = dm.TIMELINE.REG
+DOWN = dm.PPP_STATUS.DOWN
+INIT = dm.PPP_STATUS.INIT
+UP = dm.PPP_STATUS.UP
+
+T0 = 1700000000
+
+class TimelineTest(unittest.TestCase):
+    def setUp(self):
+        self.now = T0
+        patch = mock.patch.object(dm.time, 'time', lambda: self.now)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+        self.name = os.path.join(tempfile.mkdtemp(), 'timeline')
+        self.tl = dm.Timeline(self.name)
+
+    def add(self, t, kind, value):
+        self.now = T0 + t
+        self.tl.add(kind, value)
+
+    def records(self, name):
+        try:
+            with open(name, 'rb') as f:
+                return list(dm.Timeline.REC.iter_unpack(f.read()))
+        except FileNotFoundError:
+            return []
+
+    def test_availability(self):
+        self.add(0, START, 0)
+        self.add(10, PPP, UP)
+        self.add(3010, PPP, DOWN)
+        self.now = T0 + 6000
+
+        st = self.tl.stats(T0, self.now)
+        self.assertAlmostEqual(st['Availability'], 50)
+        self.assertEqual(st['Reconnects'], 0)
+
+        st = self.tl.stats(T0 + 1510, T0 + 4510)
+        self.assertAlmostEqual(st['Availability'], 50)
+
+    def test_restart_gap(self):
+        # up when the daemon stopped without recording it
+        self.add(0, START, 0)
+        self.add(1000, PPP, UP)
+        self.tl.last.clear()
+        self.add(2000, START, 0)
+        self.now = T0 + 4000
+
+        st = self.tl.stats(T0, self.now)
+        self.assertEqual(st['Availability'], 0)
+
+        # a window starting inside the gap
+        st = self.tl.stats(T0 + 1500, self.now)
+        self.assertEqual(st['Availability'], 0)
+
+    def test_connect_time(self):
+        self.add(0, START, 0)
+        self.add(10, PPP, INIT)
+        self.add(30, PPP, UP)
+        self.add(100, PPP, DOWN)
+        self.add(110, PPP, INIT)
+        self.add(150, PPP, UP)
+        self.now = T0 + 200
+
+        st = self.tl.stats(T0, self.now)
+        self.assertEqual(st['Reconnects'], 1)
+        self.assertAlmostEqual(st['MeanTimeToConnect'], 30)
+        self.assertAlmostEqual(st['Availability'], (70 + 50) / 2)
+
+    def test_out_of_range(self):
+        self.add(0, START, 0)
+        self.add(1, REG, 70000)
+        self.add(2, REG, 1)
+
+        tl = self.tl
+        self.assertEqual(len(tl.times), 2)
+        self.assertEqual(len(tl.pending), 2 * tl.REC.size)
+
+    def test_rotation(self):
+        size = dm.Timeline.REC.size
+
+        with mock.patch.object(dm, 'TIMELINE_MAX', 10 * size):
+            for i in range(35):
+                self.add(i * 10, PPP, [UP, DOWN][i % 2])
+                if i % 4 == 3:
+                    self.tl.flush(True)
+            self.tl.flush(True)
+
+        old = self.records(self.name + '.1')
+        cur = self.records(self.name)
+
+        self.assertTrue(old)
+        self.assertLessEqual(len(cur), 10)
+
+        # memory holds what is on file
+        self.assertEqual(list(self.tl.times), [r[0] for r in old + cur])
+
+        tl = dm.Timeline(self.name)
+        tl.load()
+        self.assertEqual(list(tl.times)[:-1], list(self.tl.times))
+
+        # totals are relative to the first record kept
+        def uptime(tl):
+            return [u - tl.uptime[0] for u in tl.uptime]
+        self.assertEqual(uptime(tl)[:-1], uptime(self.tl))
+
+if __name__ == '__main__':
+    unittest.main()